@@ -0,0 +1,6 @@
+"""
+Benchmarks of clean.py and main.py on synthetic visits with the schema of xrays_visits.csv
+Run from the repository root:
+    python -m benchmarks --rows 1000 100000
+    python -m benchmarks --save-baseline
+"""
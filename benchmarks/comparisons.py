@@ -0,0 +1,153 @@
+import time, datetime
+
+import pandas as pd
+import numpy as np
+
+import clean
+
+
+def synthetic_frame(rows, seed=0, departments=199):
+    """
+    Build a synthetic dataframe with the translated columns used in the analysis, see generator.py for the csv schema
+    rows: number of visits to generate
+    departments: departments are numbered from 1 to departments
+    """
+    rng = np.random.default_rng(seed)
+    entry_date = np.datetime64("2007-01-01 00:00:00") + rng.integers(0, 365*24*60, rows).astype("timedelta64[m]")
+    duration = rng.exponential(40, rows)
+    df = pd.DataFrame({
+                        "weekday": rng.integers(1, 8, rows),
+                        "hour": rng.integers(0, 24, rows),
+                        "age": rng.integers(0, 100, rows),
+                        "gender": rng.integers(1, 3, rows),
+                        "department": rng.integers(1, departments+1, rows),
+                        "duration": duration,
+                        "entry_date": pd.to_datetime(entry_date),
+                        "exit_date": pd.to_datetime(entry_date + duration.astype("timedelta64[m]")),
+                        })
+    return df
+
+
+def count_loop(df, x_axisname, y_axisname, categories=None):
+    """
+    Per-category scan formerly used in clean.build_count_barchart, kept as a reference
+    """
+    if categories is None:
+        categories = [ x for x in pd.unique(pd.Series(df[x_axisname])) ]
+        categories.sort()
+
+    data = [ df[df[x_axisname]==c].count()[x_axisname] for c in categories ]
+    df_sub = pd.DataFrame( {x_axisname: categories, y_axisname: data } )
+
+    return df_sub
+
+
+def timeit(function, *args, repeat=1):
+    """
+    Returns the best wall time in seconds of function(*args) and its last result
+    """
+    best, result = None, None
+    for r in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def bench_count_barchart(rows=10**7, columns=("weekday", "hour", "age", "gender"), seed=0):
+    """
+    Compare the per-category scan against clean.count_categories and clean.count_categories_batch
+    """
+    df = synthetic_frame(rows, seed)
+    print("Counting categories on {0:,} rows".format(rows))
+
+    total_loop, total_single = 0, 0
+    for column in columns:
+        t_loop, expected = timeit(count_loop, df, column, "patients")
+        t_single, result = timeit(clean.count_categories, df, column, "patients")
+        pd.testing.assert_frame_equal(expected, result, check_dtype=False)
+        total_loop, total_single = total_loop + t_loop, total_single + t_single
+        print("{0:>10}: loop {1:8.3f} s, single pass {2:8.3f} s, x{3:.1f}".format(column, t_loop, t_single, t_loop/t_single))
+
+    t_batch, result = timeit(clean.count_categories_batch, df, list(columns), "patients")
+    print("{0:>10}: loop {1:8.3f} s, batch {2:8.3f} s, x{3:.1f}".format("all", total_loop, t_batch, total_loop/t_batch))
+
+
+def splitdatetime_loop(df, column_name):
+    """
+    List comprehensions formerly used in clean.splitdatetime, kept as a reference
+    """
+    df["year"] = [d.year for d in df[column_name]]
+    df["month"] = [d.month for d in df[column_name]]
+    df["weekday"] = [datetime.date(d.year, d.month, d.day).isoweekday() for d in df[column_name]]
+    df["hour"] = [d.hour for d in df[column_name]]
+    return df
+
+
+def bench_splitdatetime(rows=10**6, seed=0):
+    """
+    Compare the list comprehensions against the vectorized clean.splitdatetime
+    """
+    rng = np.random.default_rng(seed)
+    start = np.datetime64("2007-01-01 00:00:00")
+    entry_date = start + rng.integers(0, 365*24*60, rows).astype("timedelta64[m]")
+    df = pd.DataFrame({"entry_date": pd.to_datetime(entry_date)})
+    print("Splitting datetimes on {0:,} rows".format(rows))
+
+    t_loop, expected = timeit(splitdatetime_loop, df.copy(), "entry_date")
+    t_vector, result = timeit(clean.splitdatetime, df.copy(), "entry_date", "en", clean.COLUMN_NAMES, False)
+    pd.testing.assert_frame_equal(expected, result, check_dtype=False)
+    print("loop {0:8.3f} s, vectorized {1:8.3f} s, x{2:.1f}".format(t_loop, t_vector, t_loop/t_vector))
+
+
+def by_criteria_loop(df__, columns, criteria_name, criteria):
+    """
+    Per criteria masks and groupbys formerly used in main.timedeltas_bars_times_by_criteria, kept as a reference
+    """
+    output = []
+    for column in columns:
+        categories = [ x for x in pd.unique(pd.Series(df__[column])) ]
+        categories.sort()
+        for c in criteria:
+            key = list(c.keys())[0]
+            if df__[df__[criteria_name]==key].count()[criteria_name] > 0:
+                d_sub = df__.loc[df__[criteria_name] == key]
+                d_tab = d_sub.groupby(["weekday"])["duration"].agg(['sum', 'min', 'mean', 'max', 'std'])
+                output.append([criteria_name, c, d_tab, [d_sub, column, categories]])
+    return output
+
+
+def bench_by_criteria(rows=10**6, departments=(50, 200, 800), seed=0):
+    """
+    Compare the per department loop against main.timedeltas_bars_times_by_criteria as departments grow
+    """
+    import main
+
+    print("Tables by department on {0:,} rows".format(rows))
+    for n in departments:
+        prepared = clean.prepare(synthetic_frame(rows, seed, n), [999], "en", clean.COLUMN_NAMES, False)
+        criteria = [{key: "Department {0}".format(key)} for key in range(1, n+1)]
+
+        # The reference loop predates the Categoricals of prepare, it runs on the integer columns it was written for
+        visits = prepared.df.astype({c: prepared.df[c].cat.categories.dtype for c in ["department", "weekday", "hour", "gender"]})
+        t_loop, expected = timeit(by_criteria_loop, visits, ["weekday", "hour"], "department", criteria)
+        t_cube, result = timeit(main.timedeltas_bars_times_by_criteria, prepared, ["weekday", "hour"], [999], "department", criteria,
+                                "en", main.MESSAGES, clean.COLUMN_NAMES, False, False)
+        for a, b in zip(expected, result):
+            pd.testing.assert_frame_equal(a[2], b[2], check_dtype=False, check_index_type=False, check_categorical=False)
+        print("{0:>5} departments: loop {1:8.3f} s, single groupby {2:8.3f} s, x{3:.1f}".format(n, t_loop, t_cube, t_loop/t_cube))
+
+
+def main():
+    """
+    Run every benchmark
+    """
+    bench_count_barchart()
+    bench_splitdatetime()
+    bench_by_criteria()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import os
+
+import pandas as pd
+import numpy as np
+
+import clean
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "xrays_visits.csv")
+DEPARTMENTS = os.path.join(os.path.dirname(SAMPLE), "departments.txt")
+
+COLUMNS = ["patient_id", "medical_id", "gender", "department", "entry_date", "exit_date", "outcome",
+           "entry_day", "entry_time", "exit_day", "exit_time", "duration", "age"]
+
+
+def fit_profile(filename=SAMPLE, departments_filename=DEPARTMENTS):
+    """
+    Distributions of the visits in filename used by synthetic_visits:
+    arrivals by hour and weekday, departments, ages (error codes included), genders and durations
+    Every hour, weekday and department of departments_filename gets a small share even if it has no visits
+    """
+    df = pd.read_csv(filename, sep=",", header=0)
+    seconds = df["entry_time"].to_numpy()
+
+    hours = np.bincount((seconds // 3600) % 24, minlength=24) + 0.5
+    # 1970-01-01 was a Thursday, weekday 0 is Monday
+    weekdays = np.bincount((seconds // 86400 + 3) % 7, minlength=7) + 0.5
+
+    codes = list(clean.read_departments(departments_filename, False))
+    departments = df["department"].value_counts().reindex(codes, fill_value=0) + 0.1
+
+    profile = {
+                "hours": hours / hours.sum(),
+                "weekdays": weekdays / weekdays.sum(),
+                "departments": departments.index.to_numpy(),
+                "departments_p": (departments / departments.sum()).to_numpy(),
+                "ages": df["age"].to_numpy(),
+                "genders": df["gender"].to_numpy(),
+                "durations": df["duration"].to_numpy(),
+                "visits_per_day": len(df) / max(df["entry_day"].nunique(), 1),
+                "visits_per_patient": len(df) / df["patient_id"].nunique(),
+                }
+    return profile
+
+
+def synthetic_visits(rows, seed=0, profile=None, start="2007-01-01"):
+    """
+    Returns a dataframe with the schema of xrays_visits.csv and rows visits drawn from profile (see fit_profile)
+    Visits start at start and span as many days as needed to keep the visits per day of the sample
+    """
+    if profile is None:
+        profile = fit_profile()
+    rng = np.random.default_rng(seed)
+
+    # Days weighted by weekday, then hour by the hourly profile and a uniform minute
+    first_day = int(np.datetime64(start, "D").astype(np.int64))
+    days = max(int(np.ceil(rows / profile["visits_per_day"])), 1)
+    day_weights = profile["weekdays"][(np.arange(first_day, first_day + days) + 3) % 7]
+    day = first_day + rng.choice(days, rows, p=day_weights / day_weights.sum())
+    hour = rng.choice(24, rows, p=profile["hours"])
+    entry_time = day.astype(np.int64) * 86400 + hour * 3600 + rng.integers(0, 60, rows) * 60
+    entry_time.sort()
+
+    duration = rng.choice(profile["durations"], rows)
+    exit_time = entry_time + duration
+
+    # Some patients come back several times, keeping their age and gender
+    patients = max(int(rows / profile["visits_per_patient"]), 1)
+    patient = rng.integers(0, patients, rows)
+    ages = rng.choice(profile["ages"], patients)
+    genders = rng.choice(profile["genders"], patients)
+
+    df = pd.DataFrame({
+                        "patient_id": 10000000 + patient,
+                        "medical_id": 20000000 + np.arange(rows),
+                        "gender": genders[patient],
+                        "department": rng.choice(profile["departments"], rows, p=profile["departments_p"]),
+                        "entry_date": pd.to_datetime(entry_time, unit="s").strftime("%Y-%m-%d %H:%M:%S"),
+                        "exit_date": pd.to_datetime(exit_time, unit="s").strftime("%Y-%m-%d %H:%M:%S"),
+                        "outcome": 13,
+                        "entry_day": entry_time // 86400,
+                        "entry_time": entry_time,
+                        "exit_day": exit_time // 86400,
+                        "exit_time": exit_time,
+                        "duration": duration,
+                        "age": ages[patient],
+                        }, columns=COLUMNS)
+    return df
+
+
+def write_visits(filename, rows, seed=0, chunksize=10**6, profile=None):
+    """
+    Write rows synthetic visits to a csv, chunksize rows at a time so that memory stays bounded
+    Every chunk continues the dates of the previous one
+    """
+    if profile is None:
+        profile = fit_profile()
+    start = np.datetime64("2007-01-01", "D")
+
+    written = 0
+    while written < rows:
+        size = min(chunksize, rows - written)
+        df = synthetic_visits(size, seed + written, profile, str(start))
+        df["medical_id"] += written
+        df.to_csv(filename, mode="w" if written == 0 else "a", header=written == 0, index=False)
+        start = start + np.timedelta64(int(np.ceil(size / profile["visits_per_day"])), "D")
+        written += size
+
+    return filename
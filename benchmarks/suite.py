@@ -0,0 +1,146 @@
+import os, sys, json, time, argparse, platform, tempfile, tracemalloc
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+import clean
+import main
+from benchmarks import generator
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+SIZES = [10**3, 10**4, 10**5]
+TOLERANCE = 0.25
+
+
+def setup(filename, rows, seed=0):
+    """
+    Write the synthetic csv and return the inputs every benchmark needs
+    """
+    generator.write_visits(filename, rows, seed)
+    d = clean.convert(filename, ",", False)
+    df = clean.column_translator(d[0], "en", clean.COLUMN_NAMES, False)
+    df["duration"] = df["duration"].div(60)
+    prepared = clean.prepare(df.copy(), [999], "en", clean.COLUMN_NAMES, False)
+    df__ = clean.clean_column_pair(prepared, "age", "entry_date", [999], False)
+    criteria = clean.read_txt(generator.DEPARTMENTS, False)
+    return {"filename": filename, "df": df, "prepared": prepared, "df__": df__, "criteria": criteria}
+
+
+def benchmarks(inputs):
+    """
+    Returns {name: function without arguments} for every stage being measured
+    """
+    def barcharts():
+        for column in ["weekday", "hour", "age", "gender"]:
+            clean.build_count_barchart(inputs["df__"], column, column, "patients", None, False)
+        plt.close("all")
+
+    return {
+            "convert": lambda: clean.convert(inputs["filename"], ",", False),
+            "splitdatetime": lambda: clean.splitdatetime(inputs["df"].copy(), "entry_date", "en", clean.COLUMN_NAMES, False),
+            "add_diff": lambda: clean.add_diff(inputs["df__"], "entry_date", "en", False, True),
+            "build_count_barchart": barcharts,
+            "timedeltas_bars_times_by_criteria": lambda: main.timedeltas_bars_times_by_criteria(
+                                                    inputs["prepared"], ["weekday", "hour"], [999], "department", inputs["criteria"],
+                                                    "en", main.MESSAGES, clean.COLUMN_NAMES, False, False),
+            "main": lambda: main.main("en", main.MESSAGES, clean.COLUMN_NAMES, False, None,
+                                      filename=inputs["filename"], show_charts=False),
+            }
+
+
+def measure(function, repeat=3, memory=True):
+    """
+    Returns the best wall time of repeat runs and, if memory, the peak traced by tracemalloc in one more run
+    """
+    seconds = min(_timed(function) for r in range(repeat))
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def _timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def run(sizes=SIZES, names=None, repeat=3, memory=True, seed=0, print_intermediate=True):
+    """
+    Run the benchmarks on synthetic visits of every size
+    returns {name: {rows: {"rows_per_second": ..., "seconds": ..., "peak_bytes": ...}}}
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sizes:
+            inputs = setup(os.path.join(directory, "visits_{0}.csv".format(rows)), rows, seed)
+            for name, function in benchmarks(inputs).items():
+                if names is not None and name not in names:
+                    continue
+                seconds, peak = measure(function, repeat, memory)
+                results.setdefault(name, {})[str(rows)] = {"rows_per_second": rows / seconds, "seconds": seconds, "peak_bytes": peak}
+                if print_intermediate:
+                    print("{0:>35} {1:>11,} rows: {2:9.4f} s {3:14,.0f} rows/s {4:>14} peak bytes".format(
+                        name, rows, seconds, rows / seconds, "-" if peak is None else "{0:,}".format(peak)))
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Returns the regressions of results against baseline: throughput lower or peak memory higher than tolerance allows
+    """
+    regressions = []
+    for name, sizes in results.items():
+        for rows, result in sizes.items():
+            reference = baseline.get("results", {}).get(name, {}).get(rows)
+            if reference is None:
+                continue
+            if result["rows_per_second"] < reference["rows_per_second"] * (1 - tolerance):
+                regressions.append("{0} ({1} rows): {2:,.0f} rows/s, baseline {3:,.0f}".format(
+                    name, rows, result["rows_per_second"], reference["rows_per_second"]))
+            if result["peak_bytes"] is not None and reference.get("peak_bytes") is not None \
+                    and result["peak_bytes"] > reference["peak_bytes"] * (1 + tolerance):
+                regressions.append("{0} ({1} rows): peak {2:,} bytes, baseline {3:,}".format(
+                    name, rows, result["peak_bytes"], reference["peak_bytes"]))
+    return regressions
+
+
+def cli(argv=None):
+    """
+    Command line: run the suite, compare it with the stored baseline or save a new one
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks of clean.py and main.py on synthetic xrays visits")
+    parser.add_argument("--rows", type=int, nargs="+", default=SIZES, help="sizes, from 10**3 to 10**8")
+    parser.add_argument("--only", nargs="+", default=None, help="names of the benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="don't trace peak memory")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = run(args.rows, args.only, args.repeat, not args.no_memory)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump({"machine": platform.platform(), "python": platform.python_version(), "results": results},
+                      file, indent=1, sort_keys=True)
+        print("Saved baseline to", args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline in", args.baseline)
+        return 0
+    with open(args.baseline) as file:
+        regressions = compare(results, json.load(file), args.tolerance)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
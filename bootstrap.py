@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+
+import clean
+import profiling
+
+STATISTICS = {"mean": lambda samples: samples.mean(axis=1), "median": lambda samples: np.median(samples, axis=1)}
+# Most values drawn at once in a resample matrix, larger groups get fewer replications per matrix
+MAX_DRAWS = 2**22
+
+
+def _resample_batch(args):
+    """
+    Statistics of replications resamples of every group, used by the process pool
+    values: values sorted by group, starts and counts: where every group is in values
+    returns {statistic: (groups, replications) array}
+    """
+    values, starts, counts, statistics, replications, seed = args
+    rng = np.random.default_rng(seed)
+    output = {name: np.full((len(counts), replications), np.nan) for name in statistics}
+
+    for g, (start, n) in enumerate(zip(starts, counts)):
+        if n == 0:
+            continue
+        group = values[start:start + n]
+        step = max(1, min(replications, MAX_DRAWS // n))
+        for first in range(0, replications, step):
+            size = min(step, replications - first)
+            # Every row is a resample: size replications drawn as a single matrix of indices
+            samples = group[rng.integers(0, n, size=(size, n))]
+            for name in statistics:
+                output[name][g, first:first + size] = STATISTICS[name](samples)
+    return output
+
+
+@profiling.timed()
+def bootstrap(values, groups=None, statistics=["mean", "median"], replications=10000, confidence=0.95, seed=0,
+              workers=None, batch_size=1000, print_intermediate=True):
+    """
+    Percentile bootstrap confidence intervals of statistics of values, for every group
+    groups: group key of every value (e.g. the department), None for a single group
+    replications are split in batches of batch_size, every batch with its own seed from seed and run by a
+    process pool of workers processes (1 to run in this process), so the result only depends on seed and batch_size
+    returns a dataframe indexed by group with count and, for every statistic, its value and its low and high limits
+    """
+    values = np.asarray(values, dtype=np.float64)
+    keep = ~np.isnan(values)
+    if groups is None:
+        groups = np.zeros(len(values), dtype=np.int64)
+    groups = groups if isinstance(groups, pd.Index) else pd.Index(groups)
+    codes, keys = groups[keep].factorize(sort=True)
+    if groups.nlevels > 1:
+        keys = pd.MultiIndex.from_tuples(keys)
+    values = values[keep]
+
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes, minlength=len(keys))
+    starts = np.cumsum(counts) - counts
+    sorted_values = values[order]
+
+    batches = [(first, min(batch_size, replications - first)) for first in range(0, replications, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    tasks = [(sorted_values, starts, counts, statistics, size, s) for (first, size), s in zip(batches, seeds)]
+
+    if workers == 1 or len(tasks) < 2:
+        results = [_resample_batch(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_resample_batch, tasks))
+
+    alpha = (1 - confidence) / 2
+    output = pd.DataFrame({"count": counts}, index=keys)
+    for name in statistics:
+        replicated = np.concatenate([r[name] for r in results], axis=1)
+        output[name] = [STATISTICS[name](sorted_values[start:start + n][np.newaxis])[0] for start, n in zip(starts, counts)]
+        output[name + "_low"] = np.quantile(replicated, alpha, axis=1)
+        output[name + "_high"] = np.quantile(replicated, 1 - alpha, axis=1)
+
+    if print_intermediate:
+        print(output)
+
+    return output
+
+
+def _group_keys(d, by):
+    """
+    Group key of every row of d by the columns in by, as tuples if there are several
+    """
+    if len(by) == 1:
+        return d[by[0]].to_numpy()
+    return pd.MultiIndex.from_frame(d[by].astype(np.int64))
+
+
+def durations(df, by, error_values=[999], language="en", column_names=clean.COLUMN_NAMES, **kwargs):
+    """
+    Bootstrap confidence intervals of the duration (minutes) by the columns in by, e.g. [weekday] or [department, hour]
+    The visits are the ones of main.timedeltas_bars_times_total, without error values in age
+    df: dataframe or clean.PreparedFrame; kwargs are passed to bootstrap
+    """
+    prepared = clean.prepare(df, error_values, language, column_names, False)
+    d = clean.clean_column_pair(prepared, column_names['age'][language], column_names['entry_date'][language], error_values, False)
+    output = bootstrap(d[column_names['duration'][language]], _group_keys(d, by), **kwargs)
+    output.index = output.index.set_names(by)
+    return output
+
+
+def interarrival_minutes(dates, groups=None, max_minutes=60):
+    """
+    Minutes between consecutive arrivals of the same group, intervals over max_minutes are left out as in main.entry_diffs
+    returns (intervals, group of every interval)
+    """
+    dates = pd.to_datetime(pd.Series(dates)).reset_index(drop=True)
+    groups = pd.Index(np.zeros(len(dates), dtype=np.int64)) if groups is None else groups
+    groups = groups if isinstance(groups, pd.Index) else pd.Index(groups)
+    keep = dates.notna().to_numpy()
+    times = dates[keep].to_numpy(dtype="datetime64[ns]").view(np.int64)
+
+    codes, keys = groups[keep].factorize(sort=True)
+    order = np.lexsort([times, codes])
+    times, codes = times[order], codes[order]
+    intervals = np.diff(times) / 10**9 / 60
+    same = codes[1:] == codes[:-1]
+    keep = same & (intervals <= max_minutes)
+    return intervals[keep], keys.take(codes[1:][keep])
+
+
+def interarrivals(df, by, error_values=[999], language="en", column_names=clean.COLUMN_NAMES, max_minutes=60, **kwargs):
+    """
+    Bootstrap confidence intervals of the minutes between arrivals by the columns in by, e.g. [hour] or [department]
+    Intervals are measured between consecutive arrivals with the same values in by
+    df: dataframe or clean.PreparedFrame; kwargs are passed to bootstrap
+    """
+    prepared = clean.prepare(df, error_values, language, column_names, False)
+    d = clean.clean_column_pair(prepared, column_names['age'][language], column_names['entry_date'][language], error_values, False)
+    intervals, groups = interarrival_minutes(d[column_names['entry_date'][language]], _group_keys(d, by), max_minutes)
+    output = bootstrap(intervals, groups, **kwargs)
+    output.index = output.index.set_names(by)
+    return output
@@ -1,10 +1,9 @@
-import pprint, datetime
+import pprint, os, json, hashlib
 
 import pandas as pd
 import numpy as np
-import matplotlib as mpl
-from matplotlib.ticker import StrMethodFormatter
-from matplotlib import axes
+
+import profiling
 
 COLUMN_NAMES = {
                 "year":
@@ -37,6 +36,38 @@ COLUMN_NAMES = {
                     {"en":"interval", "es":"intervalo"},
                 }
 
+# Pseudo-language whose names are the keys of COLUMN_NAMES and main.MESSAGES: results computed with it
+# don't depend on any language and are labelled afterwards with labels and relabel_frame
+KEY = "key"
+
+
+def with_keys(names):
+    """
+    Copy of a translation dictionary, like COLUMN_NAMES or main.MESSAGES, where the KEY language is added
+    """
+    return {key: dict(value, **{KEY: key}) for key, value in names.items()}
+
+
+def labels(language, *dictionaries):
+    """
+    Returns {key: name in language} of the translation dictionaries, the first ones take precedence
+    """
+    output = {}
+    for names in reversed(dictionaries):
+        output.update({key: value.get(language, key) for key, value in names.items()})
+    return output
+
+
+def relabel_frame(df, mapping):
+    """
+    Rename the columns and index names of df with mapping (e.g. from labels), the data isn't copied
+    """
+    output = df.rename(columns=mapping, copy=False)
+    output.index = output.index.set_names([mapping.get(name, name) for name in output.index.names])
+    return output
+
+
+@profiling.timed()
 def column_translator(df, language="en", column_names=COLUMN_NAMES, print_intermediate=True):
     """
     Rename some of the column names in a df from the standard language to language in parameters
@@ -79,12 +110,77 @@ def read_txt(filename, print_intermediate=True):
     return result
 
 
+def read_departments(filename, print_intermediate=True):
+    """
+    Enter a txt file like read_txt and convert it into a dictionary {int: str},
+    so that the name of a department is found by its code in constant time
+    """
+    return {key: value for c in read_txt(filename, print_intermediate) for key, value in c.items()}
+
+
+def criteria_items(criteria):
+    """
+    Returns a list of (key, value) from a dictionary or from a list of the form [{int: str}] as read_txt returns
+    """
+    if isinstance(criteria, dict):
+        return list(criteria.items())
+    return [item for c in criteria for item in c.items()]
+
+
+# Fixed categories of the columns turned into Categoricals by prepare
+GENDERS = [1, 2]
+WEEKDAYS = [1, 2, 3, 4, 5, 6, 7]
+HOURS = list(range(24))
+
+
+def to_categoricals(df, departments=None, language="en", column_names=COLUMN_NAMES):
+    """
+    Turn the department, gender, weekday and hour columns of df into Categoricals with fixed categories,
+    so that groupbys work on integer codes and charts keep the categories without visits
+    departments: codes of every department (e.g. read_departments), None for the ones in df
+    Values outside the fixed categories, like error codes, are kept as extra categories at the end
+    returns a shallow copy of df, whose own columns keep their dtypes
+    """
+    fixed = {"department": departments, "gender": GENDERS, "weekday": WEEKDAYS, "hour": HOURS}
+    # Replacing columns of a shallow copy doesn't copy the other columns nor change the caller's dataframe
+    df = df.copy(deep=False)
+
+    for key, categories in fixed.items():
+        name = column_names[key][language]
+        if name not in df.columns:
+            continue
+        column = df[name]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            column = column.astype(column.cat.categories.dtype)
+        observed = pd.unique(column.dropna())
+        categories = sorted(observed) if categories is None else list(categories)
+        extra = sorted(set(observed) - set(categories))
+        df[name] = pd.Categorical(column, categories=categories + extra)
+
+    return df
+
+
+def as_categoricals(df, columns):
+    """
+    df with the columns that aren't Categoricals yet turned into Categoricals of their values in the whole of df
+    returns df itself if every column already is one, a shallow copy otherwise
+    """
+    columns = [column for column in columns if not isinstance(df[column].dtype, pd.CategoricalDtype)]
+    if not columns:
+        return df
+    df = df.copy(deep=False)
+    for column in columns:
+        df[column] = df[column].astype("category")
+    return df
+
+
+@profiling.timed()
 def convert(filename, delimiter=",", print_intermediate=True):
     """
     Returns a tuple with the dataframe and the column names
     """
     # Get dataframe and headers from csv
-    df = pd.read_csv(filename, delimiter,header=0)
+    df = pd.read_csv(filename, sep=delimiter, header=0)
     header_list = list(df.columns)
 
     if print_intermediate:
@@ -99,20 +195,177 @@ def convert(filename, delimiter=",", print_intermediate=True):
     return (df, header_list)
 
 
-def build_count_barchart(df, title, x_axisname, y_axisname, categories=None, print_intermediate=True):
+def count_categories(df, x_axisname, y_axisname, categories=None):
     """
-    Build a bar chart with the count of unique values in column x_axisname within dataframe df
-    y_axisname is the count of whatever objects or units are being measured
-    categories can be customized but have to be added from outside
+    Count the unique values in column x_axisname within dataframe df in a single pass
+    categories can be customized, categories absent from df are counted as 0
+    Categorical columns use all their categories by default
+    returns a dataframe with two columns: x_axisname and y_axisname (the count)
     """
+    column = df[x_axisname]
+
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # Categoricals are counted on their codes and keep every category, even those without rows
+        codes = column.cat.codes.to_numpy()
+        counts = pd.Series(np.bincount(codes[codes >= 0], minlength=len(column.cat.categories)), index=column.cat.categories)
+        if categories is None:
+            categories = list(column.cat.categories)
+        data = counts.reindex(categories, fill_value=0).astype(np.int64).tolist()
+        return pd.DataFrame( {x_axisname: categories, y_axisname: data } )
+
+    values = column.to_numpy()
 
     if categories is None:
-        categories = [ x for x in pd.unique(pd.Series(df[x_axisname])) ]
+        categories = [ x for x in pd.unique(column.dropna()) ]
         categories.sort()
 
-    data = [ df[df[x_axisname]==c].count()[x_axisname] for c in categories ]
+    # Small non-negative integer codes (weekday, hour, age, gender...) can be counted with bincount
+    if np.issubdtype(values.dtype, np.integer) and len(values) > 0 and values.min() >= 0 and values.max() < 2**16:
+        counts = pd.Series(np.bincount(values))
+    else:
+        counts = column.value_counts(dropna=True)
+    data = counts.reindex(categories, fill_value=0).astype(np.int64).tolist()
+
     df_sub = pd.DataFrame( {x_axisname: categories, y_axisname: data } )
 
+    return df_sub
+
+
+def count_categories_batch(df, columns, y_axisname, categories=None):
+    """
+    Count the unique values of several columns (weekday, hour, age, gender...) in one call
+    categories: optional dictionary {column: list of categories}
+    returns a dictionary {column: dataframe as returned by count_categories}
+    """
+    if categories is None:
+        categories = {}
+
+    output = {}
+    for column in columns:
+        output[column] = count_categories(df, column, y_axisname, categories.get(column))
+
+    return output
+
+
+# Compact dtypes for the columns of xrays_visits.csv, used when streaming large exports
+DTYPES = {
+            "patient_id": np.int32,
+            "medical_id": np.int32,
+            "gender": np.int16,
+            "department": np.int16,
+            "outcome": np.int16,
+            "entry_day": np.int32,
+            "entry_time": np.int64,
+            "exit_day": np.int32,
+            "exit_time": np.int64,
+            "duration": np.int32,
+            "age": np.int16,
+            }
+
+
+def convert_chunks(filename, delimiter=",", chunksize=10**6, dtypes=DTYPES, date_columns=["entry_date", "exit_date"],
+                   print_intermediate=True, format = '%Y-%m-%d %H:%M:%S'):
+    """
+    Read a csv in chunks of chunksize rows with compact dtypes instead of a single read_csv
+    date_columns are parsed chunk by chunk while reading
+    returns a generator of dataframes
+    """
+    reader = pd.read_csv(filename, sep=delimiter, header=0, dtype=dtypes, chunksize=chunksize)
+
+    for chunk in reader:
+        for column_name in date_columns:
+            chunk[column_name] = pd.to_datetime(chunk[column_name], format=format)
+
+        if print_intermediate:
+            print("\nRead a chunk with {0} rows".format(len(chunk)))
+
+        yield chunk
+
+
+def aggregate_chunk(df, columns, value_name):
+    """
+    Partial aggregates of df[value_name] grouped by each column in columns
+    returns a dictionary {column: dataframe with count, sum, sumsq, min and max by category}
+    """
+    output = {}
+    values = df[value_name].astype(np.float64)
+    squares = values * values
+
+    for column in columns:
+        d_agg = values.groupby(df[column]).agg(['count', 'sum', 'min', 'max'])
+        d_agg['sumsq'] = squares.groupby(df[column]).sum()
+        output[column] = d_agg
+
+    return output
+
+
+def merge_aggregates(aggregates1, aggregates2):
+    """
+    Combine two results of aggregate_chunk, the result is the same as aggregating both chunks at once
+    """
+    if aggregates1 is None:
+        return aggregates2
+
+    output = {}
+    for column in aggregates1:
+        d_agg = pd.concat([aggregates1[column], aggregates2[column]])
+        output[column] = d_agg.groupby(level=0).agg({'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max', 'sumsq': 'sum'})
+
+    return output
+
+
+def finish_aggregates(aggregates):
+    """
+    Turn partial aggregates into tables with sum, min, mean, max, std (sample) and count, like DataFrame.agg
+    """
+    output = {}
+    for column in aggregates:
+        d_agg = aggregates[column]
+        count = d_agg['count']
+        mean = d_agg['sum'] / count
+        # Sample variance from the sums, negative rounding residues are clipped
+        variance = ((d_agg['sumsq'] - d_agg['sum'] * mean) / (count - 1)).clip(lower=0)
+        variance[count < 2] = np.nan
+        d_tab = pd.DataFrame({'sum': d_agg['sum'], 'min': d_agg['min'], 'mean': mean,
+                              'max': d_agg['max'], 'std': np.sqrt(variance), 'count': count})
+        output[column] = d_tab.sort_index()
+
+    return output
+
+
+@profiling.timed()
+def stream_aggregates(filename, columns, error_values=[999], language="en", column_names=COLUMN_NAMES, delimiter=",",
+                      chunksize=10**6, print_intermediate=True):
+    """
+    Aggregate the duration (minutes) of the visits in filename by each column in columns with bounded memory
+    Every chunk is translated, filtered from error values in age and gets the weekday and hour columns
+    columns: translated column names, as in main.timedeltas_bars_times_total
+    returns a dictionary {column: table with sum, min, mean, max, std, count}
+    """
+    aggregates = None
+
+    for chunk in convert_chunks(filename, delimiter, chunksize, DTYPES, ["entry_date", "exit_date"], print_intermediate):
+        chunk = column_translator(chunk, language, column_names, False)
+        chunk = Validity(chunk, error_values).frame([column_names['age'][language]])
+        if len(chunk) == 0:
+            continue
+        chunk = chunk.assign(**{column_names['duration'][language]: chunk[column_names['duration'][language]].div(60)})
+        chunk = splitdatetime(chunk, column_names['entry_date'][language], language, column_names, False)
+
+        aggregates = merge_aggregates(aggregates, aggregate_chunk(chunk, columns, column_names['duration'][language]))
+
+    return finish_aggregates(aggregates)
+
+
+@profiling.timed()
+def build_count_barchart(df, title, x_axisname, y_axisname, categories=None, print_intermediate=True):
+    """
+    Build a bar chart with the count of unique values in column x_axisname within dataframe df
+    y_axisname is the count of whatever objects or units are being measured
+    categories can be customized but have to be added from outside
+    """
+    df_sub = count_categories(df, x_axisname, y_axisname, categories)
+
     if print_intermediate:
         print(df_sub)
 
@@ -149,7 +402,8 @@ def customizechart(x, title, xlabel, ylabel):
     x.set_xlabel(xlabel, labelpad=20, weight='bold', size=12)
     # Set y-axis label
     x.set_ylabel(ylabel, labelpad=20, weight='bold', size=12)
-    # Format y-axis label
+    # Format y-axis label, matplotlib is only imported when a chart is drawn
+    from matplotlib.ticker import StrMethodFormatter
     x.yaxis.set_major_formatter(StrMethodFormatter('{x:,g}'))
 
 
@@ -159,7 +413,7 @@ def clean_column(df, column_name, error_values=[999]):
     returns a dataframe with just one column
     """
     # Similar to cleaned = [x for x in df['age'] if x != 999]
-    column = list(df[column_name][~df[column_name].isin(error_values)])
+    column = df[column_name].to_numpy()[Validity(df, error_values).column(column_name)]
     # Creating a new dataframe
     cleaned = pd.DataFrame({column_name: column})
 
@@ -172,6 +426,7 @@ def add_diff(df, column_name, language="en", print_intermediate=True, minutes=Tr
     then save the difference between event i and event i-1 in another column named [column_name]_prev
     minutes: convert to minutes
     returns dataframe
+    InterArrivals computes the same deltas incrementally when visits are added in batches
     """
     df_  = df.sort_values(by=[column_name])
     df__ = df_.reset_index(drop=True)
@@ -202,15 +457,296 @@ def add_diff(df, column_name, language="en", print_intermediate=True, minutes=Tr
     return df__
 
 
-def clean_column_pair(df, column_name1, column_name2=None, error_values=[999], print_intermediate=True):
+class StreamHistogram:
+    """
+    Histogram with fixed bins plus count, min, max, mean and variance, that can be fed in chunks
+    and merged with other StreamHistograms with the same bins (from other chunks or processes)
+    low, high, bins: bins edges are np.linspace(low, high, bins+1), as in np.histogram
+    Values outside [low, high] are counted in underflow and overflow, but not in the bins
+    """
+    def __init__(self, low, high, bins=10):
+        self.edges = np.linspace(low, high, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.mean = 0.0
+        # Sum of squared differences from the mean
+        self.m2 = 0.0
+
+    @classmethod
+    def from_values(cls, values, bins=10):
+        """
+        Histogram of values with bins over their whole range, the same bins np.histogram would choose
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        low, high = (values.min(), values.max()) if len(values) > 0 else (None, None)
+        return cls.for_range(low, high, bins).add(values)
+
+    @classmethod
+    def for_range(cls, low, high, bins=10):
+        """
+        Empty histogram for values between low and high (None if there are none), with the bins of from_values
+        """
+        if low is None:
+            low, high = 0.0, 1.0
+        if low == high:
+            low, high = low - 0.5, high + 0.5
+        return cls(low, high, bins)
+
+    def _bin_indices(self, values):
+        """
+        Bin of each value, with the same rounding corrections as np.histogram
+        """
+        bins = len(self.counts)
+        first, last = self.edges[0], self.edges[-1]
+        indices = ((values - first) * (bins / (last - first))).astype(np.intp)
+        indices[indices == bins] -= 1
+        indices[values < self.edges[indices]] -= 1
+        indices[(values >= self.edges[indices + 1]) & (indices != bins - 1)] += 1
+        return indices
+
+    def add(self, values):
+        """
+        Add an array of values (NaN are ignored)
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+
+        inside = (values >= self.edges[0]) & (values <= self.edges[-1])
+        self.underflow += int((values < self.edges[0]).sum())
+        self.overflow += int((values > self.edges[-1]).sum())
+        self.counts += np.bincount(self._bin_indices(values[inside]), minlength=len(self.counts))
+
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        return self._combine(len(values), values.min(), values.max(), mean, m2)
+
+    def add_nanoseconds(self, values, seconds_per_unit=60):
+        """
+        Add an int64 array of nanoseconds (or timedelta64[ns]), converted to units of seconds_per_unit seconds
+        """
+        values = np.asarray(values)
+        if values.dtype.kind == 'm':
+            nat = np.isnat(values)
+            values = values.astype("timedelta64[ns]").view(np.int64)[~nat]
+        return self.add(values / 10**9 / seconds_per_unit)
+
+    def _combine(self, count, min_, max_, mean, m2):
+        """
+        Chan's parallel update of count, min, max, mean and m2
+        """
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min, self.max = min(self.min, min_), max(self.max, max_)
+        return self
+
+    def merge(self, other):
+        """
+        Add the contents of another StreamHistogram with the same bins
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Histograms with different bins can't be merged")
+        if other.count == 0:
+            return self
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self._combine(other.count, other.min, other.max, other.mean, other.m2)
+
+    def variance(self, ddof=1):
+        return self.m2 / (self.count - ddof) if self.count > ddof else np.nan
+
+    def std(self, ddof=1):
+        return np.sqrt(self.variance(ddof))
+
+    def quantile(self, q):
+        """
+        Approximate quantile, interpolating linearly within the bins
+        """
+        cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+        if cumulative[-1] == 0:
+            return np.nan
+        return float(np.interp(q * cumulative[-1], cumulative, self.edges))
+
+    def describe(self):
+        """
+        Returns a series like pd.Series.describe, quartiles are approximate
+        """
+        return pd.Series({'count': self.count, 'mean': self.mean, 'std': self.std(), 'min': self.min,
+                          '25%': self.quantile(0.25), '50%': self.quantile(0.5), '75%': self.quantile(0.75),
+                          'max': self.max})
+
+    def table(self, columns=("divisions", "count")):
+        """
+        Returns a dataframe with the upper edge and the count of every bin
+        """
+        data = np.concatenate( ([[x] for x in self.edges.tolist()[1:]] , [[x] for x in self.counts.tolist()]) , axis=1)
+        return pd.DataFrame(data=data, index=list(range(len(self.counts))), columns=list(columns))
+
+
+class InterArrivals:
+    """
+    Sorted arrival times and the minutes between consecutive arrivals, kept as state so that new visits
+    can be added batch by batch without sorting the whole history again, see add_diff
+    max_minutes: intervals over this value are left out of intervals() and histogram()
     """
-    Create a single dataframe with just two columns
+    def __init__(self, max_minutes=60):
+        self.max_minutes = max_minutes
+        self.size = 0
+        # Arrival times in nanoseconds, sorted, and deltas[i] = times[i+1] - times[i] in minutes
+        self._times = np.empty(1024, dtype=np.int64)
+        self._deltas = np.empty(1024, dtype=np.float64)
+
+    @property
+    def times(self):
+        return self._times[:self.size]
+
+    @property
+    def deltas(self):
+        return self._deltas[:max(self.size - 1, 0)]
+
+    @property
+    def last(self):
+        return self._times[self.size - 1] if self.size > 0 else None
+
+    def _reserve(self, size):
+        """
+        Grow the buffers geometrically, so appending is amortized O(batch)
+        """
+        if size > len(self._times):
+            capacity = max(size, 2 * len(self._times))
+            self._times = np.resize(self._times, capacity)
+            self._deltas = np.resize(self._deltas, capacity)
+
+    def add(self, dates):
+        """
+        Add a batch of arrival datetimes (a series or array, NaT are ignored)
+        Intervals before the earliest new arrival are not computed again
+        """
+        batch = pd.to_datetime(pd.Series(dates)).dropna().to_numpy(dtype="datetime64[ns]").view(np.int64)
+        if len(batch) == 0:
+            return self
+        batch = np.sort(batch)
+
+        # First position whose interval changes: every arrival up to there stays in place
+        start = int(np.searchsorted(self.times, batch[0], side='right'))
+        tail = self._times[start:self.size]
+        if len(tail) > 0:
+            tail = np.sort(np.concatenate([tail, batch]), kind='mergesort')
+        else:
+            tail = batch
+
+        self._reserve(start + len(tail))
+        self._times[start:start + len(tail)] = tail
+        self.size = start + len(tail)
+
+        first = max(start - 1, 0)
+        # Same arithmetic as add_diff: nanoseconds to seconds to minutes
+        self._deltas[first:self.size - 1] = np.diff(self._times[first:self.size]) / 10**9 / 60
+
+        return self
+
+    def intervals(self):
+        """
+        Intervals in minutes in arrival order, without negative ones or those over max_minutes, as in add_diff
+        """
+        deltas = self.deltas
+        return deltas[(deltas >= 0) & (deltas <= self.max_minutes)]
+
+    def histogram(self, bins=20):
+        """
+        Returns a StreamHistogram of intervals(), with the bins np.histogram would choose
+        """
+        return StreamHistogram.from_values(self.intervals(), bins)
+
+
+class Validity:
     """
-    indexNames = []
+    Rows of a dataframe without error values
+    Every column is checked once, the checks are combined on demand and the resulting row positions
+    and filtered dataframes are kept, so the analysis functions share them instead of filtering again
+    """
+    def __init__(self, df, error_values=[999]):
+        self.df = df
+        self.error_values = list(error_values)
+        self._masks = {}
+        self._rows = {}
+        self._frames = {}
+
+    def column(self, column_name):
+        """
+        Boolean array, True where df[column_name] doesn't hold an error value
+        """
+        if column_name not in self._masks:
+            self._masks[column_name] = ~self.df[column_name].isin(self.error_values).to_numpy()
+        return self._masks[column_name]
+
+    def mask(self, columns):
+        """
+        Boolean array, True in the rows without error values in any of columns
+        """
+        mask = np.ones(len(self.df), dtype=bool)
+        for column_name in columns:
+            if column_name is not None:
+                mask &= self.column(column_name)
+        return mask
+
+    def rows(self, columns):
+        """
+        Positions of the rows without error values in any of columns
+        """
+        key = tuple(c for c in columns if c is not None)
+        if key not in self._rows:
+            self._rows[key] = np.flatnonzero(self.mask(key))
+        return self._rows[key]
+
+    def frame(self, columns):
+        """
+        Rows of df without error values in any of columns, built once and shared: don't modify it
+        df itself is returned when every row is valid
+        """
+        key = tuple(c for c in columns if c is not None)
+        if key not in self._frames:
+            rows = self.rows(key)
+            self._frames[key] = self.df if len(rows) == len(self.df) else self.df.take(rows)
+        return self._frames[key]
+
+    def counts(self, columns=None):
+        """
+        Number of error values in every column (all of them by default)
+        """
+        columns = self.df.columns if columns is None else columns
+        return pd.Series({c: int(len(self.df) - self.column(c).sum()) for c in columns}, dtype=np.int64)
+
+
+def validity(df, error_values=[999]):
+    """
+    Returns the Validity of a PreparedFrame, which is shared, if it was built with the same error_values,
+    otherwise a new one for df
+    """
+    if isinstance(df, PreparedFrame):
+        if df.validity.error_values == list(error_values):
+            return df.validity
+        df = df.df
+    return Validity(df, error_values)
 
-    df = df[df[column_name1] != 999]
-    if column_name2 is not None:
-        df = df[df[column_name2] != 999]
+
+@profiling.timed()
+def clean_column_pair(df, column_name1, column_name2=None, error_values=[999], print_intermediate=True):
+    """
+    Create a single dataframe without the rows holding error values in column_name1 or column_name2
+    df: dataframe, or PreparedFrame whose filtered rows are computed once and shared
+    """
+    df = validity(df, error_values).frame([column_name1, column_name2])
 
     if print_intermediate:
         print("\nAbridged dataframe:")
@@ -229,6 +765,7 @@ def customdescribe(df, column_name, error_values=[999], bins=20):
     return None
 
 
+@profiling.timed()
 def getdatetimes(df, column_name1, column_name2=None, error_values=[""], print_intermediate=True, format = '%Y-%m-%d %H:%M:%S'):
     """
     Converts one or two columns containing datetimes as strings to dataframes containing datetimes
@@ -256,17 +793,30 @@ def getdatetimes(df, column_name1, column_name2=None, error_values=[""], print_i
         return dates1
 
 
+def parse_dates(column, error_values=[999], format='%Y-%m-%d %H:%M:%S'):
+    """
+    Datetimes of a column of strings, NaT for the error values, given as numbers or read as strings from a csv
+    """
+    errors = list(error_values) + [str(value) for value in error_values]
+    return pd.to_datetime(column.where(~column.isin(errors)), format=format)
+
+
+@profiling.timed()
 def splitdatetime(df, column_name, language="en", column_names=COLUMN_NAMES, print_intermediate=True, format = '%Y-%m-%d %H:%M:%S'):
     """
     Add columns to dataframe with year, month, weekday, hour
     column_name: column containing datetime objects
     """
-    df[column_name] = getdatetimes(df, column_name, None, [999], print_intermediate, format)
-    df[column_names['year'][language]]  = [d.year for d in df[column_name]]
-    df[column_names["month"][language]] = [d.month for d in df[column_name]]
-    # Similar to df["weekday"]  = [datetime.date(d.year, d.month, d.day).strftime("%A") for d in df[column_name]]
-    df[column_names["weekday"][language]]  = [datetime.date(d.year, d.month, d.day).isoweekday() for d in df[column_name]]
-    df[column_names["hour"][language]]  = [d.hour for d in df[column_name]]
+    if not pd.api.types.is_datetime64_any_dtype(df[column_name]):
+        # Parsed in place, so that the index of df is kept
+        df[column_name] = parse_dates(df[column_name], [999], format)
+    # Vectorized through the .dt accessor and stored with compact nullable dtypes, missing where the date is an error value
+    dates = df[column_name].dt
+    df[column_names['year'][language]]  = dates.year.astype("Int16")
+    df[column_names["month"][language]] = dates.month.astype("Int8")
+    # Similar to df["weekday"]  = [datetime.date(d.year, d.month, d.day).isoweekday() for d in df[column_name]]
+    df[column_names["weekday"][language]]  = (dates.dayofweek + 1).astype("Int8")
+    df[column_names["hour"][language]]  = dates.hour.astype("Int8")
 
     if print_intermediate:
         print("\nProcessed datetimes:")
@@ -281,6 +831,130 @@ def splitdatetime(df, column_name, language="en", column_names=COLUMN_NAMES, pri
     return df
 
 
+class PreparedFrame:
+    """
+    Visits dataframe whose datetimes have been parsed once, to be shared by the analysis functions in main.py
+    df: dataframe with entry and exit dates as datetimes and the year, month, weekday and hour columns
+    entry_dates, exit_dates: series of datetimes without error values, as returned by getdatetimes
+    validity: Validity of df for error_values, see clean_column_pair
+    """
+    def __init__(self, df, entry_dates, exit_dates, language="en", column_names=COLUMN_NAMES, error_values=[999]):
+        self.df = df
+        self.entry_dates = entry_dates
+        self.exit_dates = exit_dates
+        self.language = language
+        self.column_names = column_names
+        self.validity = Validity(df, error_values)
+
+
+@profiling.timed()
+def prepare(df, error_values=[999], language="en", column_names=COLUMN_NAMES, print_intermediate=True, format = '%Y-%m-%d %H:%M:%S',
+            departments=None):
+    """
+    Parse the entry and exit dates and add year, month, weekday and hour exactly once
+    Department, gender, weekday and hour become Categoricals in the PreparedFrame, not in df, see to_categoricals
+    df: dataframe, modified in place as splitdatetime does, or a PreparedFrame which is returned as is
+    departments: codes of every department, None for the ones in df
+    returns a PreparedFrame
+    """
+    if isinstance(df, PreparedFrame):
+        return df
+
+    dates = []
+    for column_name in [column_names['entry_date'][language], column_names['exit_date'][language]]:
+        # Columns that were already parsed are not parsed again
+        if not pd.api.types.is_datetime64_any_dtype(df[column_name]):
+            df[column_name] = parse_dates(df[column_name], error_values, format)
+        dates.append(df[column_name].dropna().reset_index(drop=True))
+
+    df = splitdatetime(df, column_names['entry_date'][language], language, column_names, print_intermediate, format)
+    df = to_categoricals(df, departments, language, column_names)
+
+    return PreparedFrame(df, dates[0], dates[1], language, column_names, error_values)
+
+
+# Prepared dataframes are cached here as Feather files, bump CACHE_VERSION when prepare changes its output
+CACHE_DIR = ".cache"
+CACHE_VERSION = 3
+
+
+def cache_name(filename, *settings):
+    """
+    Prefix of the cached versions of filename: its name, a hash of its resolved path, so that files with the same name
+    in different directories don't replace each other's cache, and settings
+    """
+    path_hash = hashlib.sha1(os.path.realpath(filename).encode()).hexdigest()[:8]
+    return ".".join([os.path.splitext(os.path.basename(filename))[0], path_hash] + [str(setting) for setting in settings])
+
+
+def cache_key(filename, error_values=[999], language="en", column_names=COLUMN_NAMES, hash_contents=False, departments=None):
+    """
+    Returns a key identifying the prepared version of filename from its size and modification time,
+    a hash of its contents if hash_contents, and the settings used to prepare it
+    """
+    stat = os.stat(filename)
+    key = [CACHE_VERSION, os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, error_values, language, column_names,
+           None if departments is None else list(departments)]
+
+    if hash_contents:
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as file:
+            for block in iter(lambda: file.read(2**20), b''):
+                digest.update(block)
+        key.append(digest.hexdigest())
+
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@profiling.timed()
+def load_prepared(filename, delimiter=",", error_values=[999], language="en", column_names=COLUMN_NAMES,
+                  cache_dir=CACHE_DIR, hash_contents=False, print_intermediate=True, departments=None):
+    """
+    Read filename, translate its columns, convert the duration from seconds to minutes and prepare it
+    The prepared dataframe is stored in cache_dir and memory-mapped by later calls
+    until filename, error_values, language, column_names or departments change
+    cache_dir: None to always read the csv
+    departments: codes of every department, see prepare
+    returns a PreparedFrame
+    """
+    path = None
+    if cache_dir is not None:
+        try:
+            from pyarrow import feather
+        except ImportError:
+            print("pyarrow is not installed, the prepared dataframe won't be cached")
+            cache_dir = None
+
+    if cache_dir is not None:
+        name = cache_name(filename, language)
+        key = cache_key(filename, error_values, language, column_names, hash_contents, departments)
+        path = os.path.join(cache_dir, "{0}.{1}.feather".format(name, key))
+
+        if os.path.exists(path):
+            if print_intermediate:
+                print("\nLoading cached dataframe:", path)
+            # The cached columns are already prepared, only the series of dates are rebuilt
+            df = feather.read_table(path, memory_map=True).to_pandas()
+            dates = [df[column_names[column][language]].dropna().reset_index(drop=True) for column in ["entry_date", "exit_date"]]
+            return PreparedFrame(df, dates[0], dates[1], language, column_names, error_values)
+
+    d = convert(filename, delimiter, print_intermediate)
+    df = column_translator(d[0], language, column_names, print_intermediate)
+    df[column_names['duration'][language]] = df[column_names['duration'][language]].div(60)
+    prepared = prepare(df, error_values, language, column_names, print_intermediate, departments=departments)
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Remove stale versions of the same file, then write atomically
+        for old in os.listdir(cache_dir):
+            if old.startswith(name + ".") and old.endswith(".feather"):
+                os.remove(os.path.join(cache_dir, old))
+        feather.write_feather(prepared.df.reset_index(drop=True), path + ".tmp", compression="uncompressed")
+        os.replace(path + ".tmp", path)
+
+    return prepared
+
+
 def main (print_intermediate=False):
     """
     Test some functions
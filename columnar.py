@@ -0,0 +1,180 @@
+import os, json
+
+import numpy as np
+
+import clean
+import profiling
+
+# Columns of xrays_visits.csv kept in the store, with the compact dtypes of clean.DTYPES
+COLUMNS = ["patient_id", "department", "gender", "age", "entry_time", "exit_time", "duration"]
+DTYPES = {c: clean.DTYPES[c] for c in COLUMNS}
+# entry_order.npy holds the positions of the visits sorted by entry_time, for the inter-arrival deltas
+ORDER = "entry_order"
+BLOCK_SIZE = 2**20
+SECONDS_PER_DAY = 86400
+
+
+def _path(directory, column):
+    return os.path.join(directory, column + ".npy")
+
+
+def _copy_blocks(source, target, offset=0, block_size=BLOCK_SIZE):
+    """
+    Copy the array source into target[offset:] block by block
+    """
+    for first in range(0, len(source), block_size):
+        block = source[first:first + block_size]
+        target[offset + first:offset + first + len(block)] = block
+
+
+@profiling.timed()
+def write_store(filename, directory, delimiter=",", chunksize=10**6, append=False, print_intermediate=True):
+    """
+    Write the columns of the visits in filename to directory, one fixed dtype .npy file per column,
+    reading the csv chunk by chunk so that memory doesn't grow with the file
+    append: add the visits to the ones already in directory, e.g. a new month of history
+    Sorting by entry time for entry_order.npy is the only step that holds a whole column in memory
+    returns the metadata of the store
+    """
+    os.makedirs(directory, exist_ok=True)
+    previous = open_store(directory) if append and os.path.exists(os.path.join(directory, "store.json")) else None
+
+    # Chunks are appended to raw files first, since the length of the .npy files isn't known yet
+    raw = {c: open(_path(directory, c) + ".raw", "wb") for c in COLUMNS}
+    rows = 0
+    try:
+        for chunk in clean.convert_chunks(filename, delimiter, chunksize, clean.DTYPES, [], print_intermediate):
+            for c in COLUMNS:
+                raw[c].write(np.ascontiguousarray(chunk[c].to_numpy(dtype=DTYPES[c])).tobytes())
+            rows += len(chunk)
+    finally:
+        for file in raw.values():
+            file.close()
+
+    offset = len(previous["entry_time"]) if previous is not None else 0
+    for c in COLUMNS:
+        new = np.memmap(_path(directory, c) + ".raw", dtype=DTYPES[c], mode="r", shape=(rows,)) if rows > 0 else np.empty(0, DTYPES[c])
+        target = np.lib.format.open_memmap(_path(directory, c) + ".tmp", mode="w+", dtype=DTYPES[c], shape=(offset + rows,))
+        if previous is not None:
+            _copy_blocks(previous[c], target)
+        _copy_blocks(new, target, offset)
+        target.flush()
+        del target, new
+        os.replace(_path(directory, c) + ".tmp", _path(directory, c))
+        os.remove(_path(directory, c) + ".raw")
+    del previous
+
+    entry_time = np.load(_path(directory, "entry_time"), mmap_mode="r")
+    np.save(_path(directory, ORDER), np.argsort(entry_time, kind="stable"))
+
+    metadata = {"rows": offset + rows, "columns": COLUMNS, "dtypes": {c: np.dtype(DTYPES[c]).name for c in COLUMNS}}
+    with open(os.path.join(directory, "store.json"), "w") as file:
+        json.dump(metadata, file, indent=1)
+
+    if print_intermediate:
+        print("\nStored {0} visits ({1} new) in {2}".format(offset + rows, rows, directory))
+
+    return metadata
+
+
+def open_store(directory):
+    """
+    Returns {column: np.memmap} of a store written by write_store, nothing is read until it is used
+    """
+    columns = COLUMNS + [ORDER]
+    return {c: np.load(_path(directory, c), mmap_mode="r") for c in columns}
+
+
+def blocks(store, columns, block_size=BLOCK_SIZE, error_values=[999]):
+    """
+    Generator of {column: array} with block_size visits at a time, without the visits whose age is an error value
+    Besides the stored columns, hour and weekday (1 is Monday) are derived from entry_time
+    """
+    rows = len(store["entry_time"])
+    for first in range(0, rows, block_size):
+        block = slice(first, first + block_size)
+        valid = ~np.isin(store["age"][block], error_values)
+        yield _derive(store, block, columns, valid)
+
+
+def _derive(store, rows, columns, valid):
+    output = {}
+    for c in columns:
+        if c == "hour":
+            output[c] = (np.asarray(store["entry_time"][rows])[valid] // 3600) % 24
+        elif c == "weekday":
+            # 1970-01-01 was a Thursday
+            output[c] = (np.asarray(store["entry_time"][rows])[valid] // SECONDS_PER_DAY + 3) % 7 + 1
+        else:
+            output[c] = np.asarray(store[c][rows])[valid]
+    return output
+
+
+@profiling.timed()
+def counts(store, column, block_size=BLOCK_SIZE, error_values=[999]):
+    """
+    Number of visits by hour, weekday, department, gender or age, as in the bar charts of main.py
+    returns a dictionary {value: count} sorted by value
+    """
+    total = np.zeros(0, dtype=np.int64)
+    for block in blocks(store, [column], block_size, error_values):
+        values = block[column].astype(np.int64)
+        if len(values) == 0:
+            continue
+        block_counts = np.bincount(values)
+        if len(block_counts) > len(total):
+            total = np.concatenate([total, np.zeros(len(block_counts) - len(total), dtype=np.int64)])
+        total[:len(block_counts)] += block_counts
+    return {int(value): int(total[value]) for value in np.flatnonzero(total)}
+
+
+@profiling.timed()
+def duration_histogram(store, bins=10, block_size=BLOCK_SIZE, error_values=[]):
+    """
+    clean.StreamHistogram of the whole minutes between entry and exit, as main.timedeltas_hist_bylength
+    Two passes over the blocks: the range of the minutes, then the histogram
+    """
+    def minutes():
+        for block in blocks(store, ["entry_time", "exit_time"], block_size, error_values):
+            yield (block["exit_time"] - block["entry_time"]) // 60
+
+    return _histogram(minutes, bins)
+
+
+@profiling.timed()
+def interarrival_histogram(store, bins=20, max_minutes=60, block_size=BLOCK_SIZE, error_values=[999]):
+    """
+    clean.StreamHistogram of the minutes between consecutive arrivals, as main.entry_diffs
+    The visits are read in entry order through entry_order.npy, the last arrival of a block is carried to the next one
+    """
+    order = store[ORDER]
+
+    def intervals():
+        last = None
+        for first in range(0, len(order), block_size):
+            rows = np.asarray(order[first:first + block_size])
+            valid = ~np.isin(store["age"][rows], error_values)
+            times = np.asarray(store["entry_time"][rows])[valid]
+            if len(times) == 0:
+                continue
+            deltas = np.diff(times if last is None else np.concatenate([[last], times])) / 60
+            last = times[-1]
+            yield deltas[(deltas >= 0) & (deltas <= max_minutes)]
+
+    return _histogram(intervals, bins)
+
+
+def _histogram(values, bins):
+    """
+    Histogram of the arrays generated by values(), with the bins of clean.StreamHistogram.from_values
+    """
+    low, high = None, None
+    for block in values():
+        if len(block) > 0:
+            low = block.min() if low is None else min(low, block.min())
+            high = block.max() if high is None else max(high, block.max())
+
+    histogram = clean.StreamHistogram.for_range(low, high, bins)
+    for block in values():
+        histogram.add(block)
+    return histogram
@@ -0,0 +1,174 @@
+import os, re, shutil
+
+import pandas as pd
+import numpy as np
+
+import clean
+import profiling
+
+# Largest number of rows of an Excel sheet, larger tables are only exported to Parquet
+EXCEL_ROWS = 2**20 - 1
+
+
+def keys(language="en", messages={}, column_names=clean.COLUMN_NAMES):
+    """
+    Returns {name in language: key} of the column names and messages, the inverse of clean.labels
+    so that exported tables are identified by the same keys in every language
+    """
+    output = {}
+    for names in [messages, column_names]:
+        output.update({value: key for key, value in clean.labels(language, names).items()})
+    return output
+
+
+def result_tables(output, language="en", messages={}, column_names=clean.COLUMN_NAMES):
+    """
+    Generator of the tables in the output of main.report as (stage, department, column, table)
+    department: code of the department, None for the tables of every department
+    column: key of the column the table is indexed by (e.g. weekday), the same in every language
+    Every table is generated once, the tables by department are shared by the charts of every column
+    """
+    names = keys(language, messages, column_names)
+
+    if "durations" in output:
+        yield "durations", None, "duration", output["durations"][0]
+    if output.get("totals") is not None:
+        for d_tab in output["totals"][0]:
+            yield "totals", None, names.get(d_tab.index.name, d_tab.index.name), d_tab
+    seen = set()
+    for criteria_name, c, d_tab, histogram_info in output.get("by-department", []):
+        department = list(c.keys())[0]
+        if department not in seen:
+            seen.add(department)
+            yield "by-department", department, names.get(d_tab.index.name, d_tab.index.name), d_tab
+    if "inter-arrival" in output:
+        yield "inter-arrival", None, "interval", output["inter-arrival"][0]
+    if "occupancy" in output:
+        yield "occupancy", None, None, output["occupancy"][0]
+        yield "occupancy", None, "department", output["occupancy"][1]
+
+
+def tidy(table, department=None, column=None, names={}):
+    """
+    Long format of a table with a row for every cell: department, column, position and label of the row,
+    measure (the column of the table) and its value
+    Datetimes go to time instead of value, timedeltas are converted to minutes
+    names: {name in a language: key} from keys, to label rows and measures with their keys
+    """
+    n, m = table.shape
+    values = np.full((n, m), np.nan)
+    times = np.full((n, m), np.datetime64("NaT"), dtype="datetime64[ns]")
+    for j, name in enumerate(table.columns):
+        column_values = table.iloc[:, j]
+        if pd.api.types.is_datetime64_any_dtype(column_values):
+            times[:, j] = column_values.to_numpy(dtype="datetime64[ns]")
+        elif pd.api.types.is_timedelta64_dtype(column_values):
+            values[:, j] = column_values.dt.total_seconds().to_numpy() / 60
+        else:
+            values[:, j] = column_values.to_numpy(dtype=np.float64)
+
+    rows = [str(names.get(label, label)) if isinstance(label, str) else str(label) for label in table.index]
+    measures = [str(names.get(name, name)) if isinstance(name, str) else str(name) for name in table.columns]
+    return pd.DataFrame({"department": pd.array(np.full(n * m, department if department is not None else pd.NA), dtype="Int64"),
+                         "column": pd.array(np.full(n * m, column), dtype="string"),
+                         "position": np.repeat(np.arange(n, dtype=np.int64), m),
+                         "row": np.repeat(np.array(rows, dtype=object), m),
+                         "measure": np.tile(np.array(measures, dtype=object), n),
+                         "value": values.ravel(),
+                         "time": times.ravel()})
+
+
+def sheet_name(stage, department, column, used):
+    """
+    Excel sheet name of a table, at most 31 characters without the ones Excel doesn't allow, unique in used
+    """
+    name = ".".join(str(part) for part in [stage, department, column] if part is not None)
+    name = re.sub(r"[\[\]:*?/\\]", "_", name)[:31]
+    candidate, i = name, 1
+    while candidate in used:
+        suffix = "~{0}".format(i)
+        candidate, i = name[:31 - len(suffix)] + suffix, i + 1
+    used.add(candidate)
+    return candidate
+
+
+def _write_sheet(workbook, table, stage, department, column, used, sheets, index=True):
+    """
+    Write table to its own sheet of workbook unless it has more rows than EXCEL_ROWS,
+    and add it to sheets, the index of the workbook, with an empty sheet name if it was skipped
+    """
+    name = None
+    if len(table) <= EXCEL_ROWS:
+        name = sheet_name(stage, department, column, used)
+        table.to_excel(workbook, sheet_name=name, index=index)
+    sheets.append({"sheet": name, "stage": stage, "department": department, "column": column, "rows": len(table)})
+
+
+@profiling.timed()
+def export(output, directory="report", language="en", messages={}, column_names=clean.COLUMN_NAMES, visits=None,
+           excel=False, print_intermediate=True):
+    """
+    Write every table of main.report to a Parquet dataset in directory/tables, in a single pass over the tables
+    The dataset is partitioned by stage (directory/tables/stage=totals/...), replacing the stages of earlier exports,
+    and holds tidy rows, with department and column as the stable keys of every table and the measures named by their keys, see tidy
+    visits: the cleaned dataframe (e.g. main.main's d_t), written to directory/visits partitioned by department
+    excel: also write directory/report.xlsx with a sheet per table, listed with their keys in the last sheet;
+    tables with more than EXCEL_ROWS rows are only listed there, with an empty sheet name
+    returns the list of files
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    names = keys(language, messages, column_names)
+    root = os.path.join(directory, "tables")
+    os.makedirs(root, exist_ok=True)
+    # Stages of earlier exports would be read together with this one's
+    for old in os.listdir(root):
+        if old.startswith("stage="):
+            shutil.rmtree(os.path.join(root, old))
+    schema = pa.schema([("department", pa.int64()), ("column", pa.string()), ("position", pa.int64()), ("row", pa.string()),
+                        ("measure", pa.string()), ("value", pa.float64()), ("time", pa.timestamp("ns"))])
+
+    workbook = None
+    if excel:
+        try:
+            workbook = pd.ExcelWriter(os.path.join(directory, "report.xlsx"))
+        except ImportError:
+            print("openpyxl or xlsxwriter is not installed, the Excel workbook won't be written")
+
+    writers, paths, sheets, used = {}, [], [], {"tables"}
+    try:
+        for stage, department, column, table in result_tables(output, language, messages, column_names):
+            # One file per stage, every table is appended to it as it is converted
+            if stage not in writers:
+                path = os.path.join(root, "stage={0}".format(stage), "part-0.parquet")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                writers[stage] = pq.ParquetWriter(path, schema)
+                paths.append(path)
+            writers[stage].write_table(pa.Table.from_pandas(tidy(table, department, column, names), schema=schema, preserve_index=False))
+
+            if workbook is not None:
+                _write_sheet(workbook, table, stage, department, column, used, sheets)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    if visits is not None:
+        department = column_names["department"].get(language, "department")
+        visits_root = os.path.join(directory, "visits")
+        pq.write_to_dataset(pa.Table.from_pandas(visits, preserve_index=False), visits_root,
+                            partition_cols=[department] if department in visits.columns else None,
+                            existing_data_behavior="delete_matching")
+        paths.append(visits_root)
+        if workbook is not None:
+            _write_sheet(workbook, visits, "visits", None, None, used, sheets, index=False)
+
+    if workbook is not None:
+        pd.DataFrame(sheets, columns=["sheet", "stage", "department", "column", "rows"]).to_excel(workbook, sheet_name="tables", index=False)
+        workbook.close()
+        paths.append(os.path.join(directory, "report.xlsx"))
+
+    if print_intermediate:
+        print("\nExported {0} stages to {1}".format(len(writers), directory))
+
+    return paths
@@ -0,0 +1,131 @@
+import os, glob, json, hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import pandas as pd
+
+import clean
+import profiling
+import scenarios
+
+# Header of xrays_visits.csv, every file has to have these columns in this order
+SCHEMA = ["patient_id", "medical_id", "gender", "department", "entry_date", "exit_date", "outcome",
+          "entry_day", "entry_time", "exit_day", "exit_time", "duration", "age"]
+
+
+def is_many(filename):
+    """
+    True if filename is a list of paths or a glob pattern instead of a single file
+    """
+    return not isinstance(filename, str) or glob.has_magic(filename)
+
+
+def check_header(filename, delimiter=",", schema=SCHEMA):
+    """
+    Raise a ValueError if the header of filename doesn't match schema
+    """
+    header = pd.read_csv(filename, sep=delimiter, header=0, nrows=0).columns.tolist()
+    if header != schema:
+        missing = [c for c in schema if c not in header]
+        unexpected = [c for c in header if c not in schema]
+        raise ValueError("{0} doesn't match the schema of the visits: missing {1}, unexpected {2}{3}".format(
+            filename, missing, unexpected, "" if missing or unexpected else ", different order"))
+    return header
+
+
+def file_key(filename, delimiter=","):
+    """
+    Returns a key identifying the parsed version of filename from its size and modification time
+    """
+    stat = os.stat(filename)
+    key = [clean.CACHE_VERSION, os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, delimiter]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+def load_file(filename, delimiter=",", cache_dir=clean.CACHE_DIR):
+    """
+    Parse one file as clean.convert does, cached in cache_dir until the file changes
+    returns (dataframe, True if it was parsed, False if it came from the cache)
+    """
+    path = None
+    if cache_dir is not None:
+        # Files with the same name in different directories (e.g. one per site) don't share their cache
+        name = "{0}.{1}".format(os.path.splitext(os.path.basename(filename))[0],
+                                hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:8])
+        path = os.path.join(cache_dir, "files", "{0}.{1}.feather".format(name, file_key(filename, delimiter)))
+        if os.path.exists(path):
+            from pyarrow import feather
+            return feather.read_table(path, memory_map=True).to_pandas(), False
+
+    df = pd.read_csv(filename, sep=delimiter, header=0)
+
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Remove stale versions of the same file, then write atomically
+        for old in os.listdir(os.path.dirname(path)):
+            if old.startswith(name + ".") and old.endswith(".feather"):
+                os.remove(os.path.join(os.path.dirname(path), old))
+        from pyarrow import feather
+        feather.write_feather(df, path + ".tmp", compression="uncompressed")
+        os.replace(path + ".tmp", path)
+    return df, True
+
+
+def _load_file(args):
+    return load_file(*args)
+
+
+@profiling.timed()
+def load_visits(paths, delimiter=",", workers=None, cache_dir=clean.CACHE_DIR, processes=False, print_intermediate=True):
+    """
+    Read many visit files (e.g. one per month and site) concurrently into a single dataframe
+    paths: glob pattern (e.g. "visits/*.csv") or list of patterns and paths, read in sorted order
+    Headers are checked against SCHEMA before parsing, and only new or changed files are parsed
+    workers: threads (processes if processes) parsing the files, None for the default of the executor
+    Returns a tuple with the dataframe and the column names, like clean.convert
+    """
+    if cache_dir is not None:
+        try:
+            import pyarrow
+            # pyarrow loads its pandas support lazily, which isn't thread safe: load it before the threads start
+            pyarrow.Table.from_pandas(pd.DataFrame())
+        except ImportError:
+            print("pyarrow is not installed, the parsed files won't be cached")
+            cache_dir = None
+
+    paths = scenarios.scenario_paths(paths)
+    if not paths:
+        raise ValueError("No visit files were found")
+    for path in paths:
+        check_header(path, delimiter)
+
+    tasks = [(path, delimiter, cache_dir) for path in paths]
+    if processes:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_load_file, tasks))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_load_file, tasks))
+
+    # A single concatenation in the order of the paths, empty files would turn the columns into objects
+    frames = [r[0] for r in results if len(r[0]) > 0] or [results[0][0]]
+    df = pd.concat(frames, ignore_index=True, copy=False)
+
+    if print_intermediate:
+        print("\nLoaded {0} files ({1} parsed, {2} cached), {3} rows".format(
+            len(paths), sum(r[1] for r in results), sum(not r[1] for r in results), len(df)))
+
+    return (df, list(df.columns))
+
+
+@profiling.timed()
+def load_prepared(paths, delimiter=",", error_values=[999], language="en", column_names=clean.COLUMN_NAMES,
+                  cache_dir=clean.CACHE_DIR, workers=None, print_intermediate=True, departments=None):
+    """
+    Read many visit files with load_visits, translate them, convert the duration from seconds to minutes
+    and prepare them, as clean.load_prepared does for a single file
+    returns a clean.PreparedFrame
+    """
+    d = load_visits(paths, delimiter, workers, cache_dir, False, print_intermediate)
+    df = clean.column_translator(d[0], language, column_names, print_intermediate)
+    df[column_names['duration'][language]] = df[column_names['duration'][language]].div(60)
+    return clean.prepare(df, error_values, language, column_names, print_intermediate, departments=departments)
@@ -1,9 +1,16 @@
+import os, sys, argparse
 import pandas as pd
 import numpy as np
-import matplotlib as plt
 import pprint
 
 import clean
+import export
+import ingest
+import occupancy
+import rollup
+import render
+import shards
+import profiling
 
 MESSAGES = {
             "Filtering by criteria:":
@@ -46,18 +53,27 @@ MESSAGES = {
                 {"en":"Histogram bins:", "es":"Rangos del histograma:"},
             "Interval between patient arrivals":
                 {"en":"Interval between patient arrivals", "es":"Intervalo entre llegadas de pacientes"},
+            "Patients in the X-ray unit":
+                {"en":"Patients in the X-ray unit", "es":"Pacientes en la unidad de rayos X"},
+            "time":
+                {"en":"time", "es":"tiempo"},
+            "total":
+                {"en":"total", "es":"total"},
+            "Error values by column:":
+                {"en":"Error values by column:", "es":"Valores de error por columna:"},
             }
 
 
-def timedeltas_hist_bylength(later, before, language="en", messages=MESSAGES, column_names=clean.COLUMN_NAMES, print_intermediate=True):
+@profiling.timed()
+def timedeltas_hist_bylength(later, before, language="en", messages=MESSAGES, column_names=clean.COLUMN_NAMES, print_intermediate=True,
+                             show_charts=True):
     """
     Total of everything in a histogram
     later: later datetimes, before: previous datetimes
     """
-    intervals = [x for x in list(later-before)]
-    intervals = pd.to_numeric(intervals, errors='ignore')
-    intervals = pd.DataFrame({column_names['duration'][language]: intervals})
-    intervals = ((1/60) * intervals / np.timedelta64(1, 's')).astype(int)
+    # Whole minutes, computed on the nanoseconds without building a timedelta per row
+    nanoseconds = (later - before).to_numpy(dtype="timedelta64[ns]").view(np.int64)
+    intervals = pd.DataFrame({column_names['duration'][language]: ((1/60) * (nanoseconds / 10**9)).astype(int)})
 
     if print_intermediate:
         print("\n"+"#"*50)
@@ -66,15 +82,13 @@ def timedeltas_hist_bylength(later, before, language="en", messages=MESSAGES, co
         print("\n")
         intervals.describe()
 
-    ax = intervals.hist(bins=10)
-    title, xlabel, ylabel = messages["Time spent at the X-ray unit"][language], messages["minutes"][language], messages["patients"][language]
-    clean.customizehistogram(ax, title, xlabel, ylabel)
+    if show_charts:
+        ax = intervals.hist(bins=10)
+        title, xlabel, ylabel = messages["Time spent at the X-ray unit"][language], messages["minutes"][language], messages["patients"][language]
+        clean.customizehistogram(ax, title, xlabel, ylabel)
 
-    count, divisions = np.histogram(intervals)
-    columns = [messages["divisions"][language], messages["count"][language]]
-    rows = list(range(10))
-    data = np.concatenate( ([[x] for x in divisions.tolist()[1:]] , [[x] for x in count.tolist()]) , axis=1)
-    output_df = pd.DataFrame(data=data, index=rows, columns=columns)
+    histogram = clean.StreamHistogram.from_values(intervals[column_names['duration'][language]].to_numpy(), 10)
+    output_df = histogram.table([messages["divisions"][language], messages["count"][language]])
 
     if print_intermediate:
         print(messages["Histogram bins:"][language])
@@ -83,25 +97,31 @@ def timedeltas_hist_bylength(later, before, language="en", messages=MESSAGES, co
     return output_df, intervals
 
 
+@profiling.timed()
 def timedeltas_hist_times_total(df,
                                 error_values=[999],
                                 language="en",
                                 messages=MESSAGES,
                                 column_names=clean.COLUMN_NAMES,
-                                print_intermediate=True):
+                                print_intermediate=True,
+                                show_charts=True):
     """
     Show histograms by hour, weekday, etc.
+    df: dataframe or clean.PreparedFrame, dates are only parsed if they haven't been already
     Criteria: list of criteria in another column
     """
-    df_ = clean.splitdatetime(df, column_names['entry_date'][language], language, column_names, print_intermediate)
-    df__ = clean.clean_column_pair(df_, column_names['age'][language], column_names['entry_date'][language], error_values)
+    prepared = clean.prepare(df, error_values, language, column_names, print_intermediate)
+    if not show_charts:
+        return None
+    df__ = clean.clean_column_pair(prepared, column_names['age'][language], column_names['entry_date'][language], error_values, print_intermediate)
 
-    ax1 = df__.hist(column=column_names['hour'][language], bins=24)
+    # DataFrame.hist only takes numerical columns, not the Categoricals of clean.prepare
+    ax1 = df__[[column_names['hour'][language]]].astype(np.float64).hist(bins=24)
     title, xlabel, ylabel = messages["All patients entering the X-ray unit by hour"][language],\
                             messages["hour"][language], messages["patients"][language]
     clean.customizehistogram(ax1, title, xlabel, ylabel)
 
-    ax2 = df__.hist(column=column_names['weekday'][language], bins=7)
+    ax2 = df__[[column_names['weekday'][language]]].astype(np.float64).hist(bins=7)
     title, xlabel, ylabel = messages["All patients entering the X-ray unit by weekday"][language],\
                             messages["weekday"][language], messages["patients"][language]
     clean.customizehistogram(ax2, title, xlabel, ylabel)
@@ -113,6 +133,7 @@ def timedeltas_hist_times_total(df,
 
 
 
+@profiling.timed()
 def timedeltas_hist_times_by_criteria(  df,
                                         error_values=[999],
                                         criteria_name=None,
@@ -123,10 +144,11 @@ def timedeltas_hist_times_by_criteria(  df,
                                         print_intermediate=True):
     """
     Show histograms by hour, weekday, etc.
-    Criteria: list of criteria in another column
+    df: dataframe or clean.PreparedFrame, dates are only parsed if they haven't been already
+    Criteria: list of criteria in another column, {code: name} as clean.read_departments returns or the list of clean.read_txt
     """
-    df_ = clean.splitdatetime(df, column_names['entry_date'][language], language, column_names, print_intermediate)
-    df__ = clean.clean_column_pair(df_, column_names['age'][language], column_names['entry_date'][language], error_values, print_intermediate)
+    prepared = clean.prepare(df, error_values, language, column_names, print_intermediate)
+    df__ = clean.clean_column_pair(prepared, column_names['age'][language], column_names['entry_date'][language], error_values, print_intermediate)
 
     if criteria_name is not None and criteria is not None:
         # Show criteria
@@ -134,21 +156,19 @@ def timedeltas_hist_times_by_criteria(  df,
             print(criteria_name)
             pprint.pprint(criteria)
 
-        for c in criteria:
-            key = list(c.keys())[0]
-            value = c[key]
-
+        for key, value in clean.criteria_items(criteria):
             # Don't make empty charts
-            if df[df[criteria_name]==key].count()[criteria_name] > 0:
+            if df__[df__[criteria_name]==key].count()[criteria_name] > 0:
                 print("\n")
                 print(messages["Filtering by criteria:"][language], criteria_name, "=", "(", key, ",", value, ")")
-                d_sub = df__.loc[df[criteria_name] == key]
+                d_sub = df__.loc[df__[criteria_name] == key]
 
-                ax = d_sub.hist(column=column_names['hour'][language], bins=24)
+                # DataFrame.hist only takes numerical columns, not the Categoricals of clean.prepare
+                ax = d_sub[[column_names['hour'][language]]].astype(np.float64).hist(bins=24)
                 title, xlabel, ylabel = str(key) + " " + value, messages["hour"][language], messages["patients"][language]
                 clean.customizehistogram(ax, title, xlabel, ylabel)
 
-                ax = d_sub.hist(column=column_names['weekday'][language], bins=7)
+                ax = d_sub[[column_names['weekday'][language]]].astype(np.float64).hist(bins=7)
                 title, xlabel, ylabel = str(key) + " " + value, messages["weekday"][language], messages["patients"][language]
                 clean.customizehistogram(ax, title, xlabel, ylabel)
 
@@ -160,6 +180,7 @@ def timedeltas_hist_times_by_criteria(  df,
 
 
 
+@profiling.timed()
 def timedeltas_bars_times_total(df,
                                 columns=None,
                                 error_values=[999],
@@ -167,23 +188,30 @@ def timedeltas_bars_times_total(df,
                                 messages=MESSAGES,
                                 column_names=clean.COLUMN_NAMES,
                                 print_intermediate=True,
-                                show_charts=True):
+                                show_charts=True,
+                                cube=None):
     """
     Show bar chart by hour, weekday, etc.
+    df: dataframe or clean.PreparedFrame
     columns: columns to show
     Criteria: list of criteria in another column
+    cube: rollup.RollupCube of df, the tables of its dimensions are computed from it instead of the visits
     Output: list of dataframes and related information
     """
     output = []
 
     if columns is not None:
-        df_ = clean.splitdatetime(df, column_names['entry_date'][language], language, column_names, print_intermediate)
-        df__ = clean.clean_column_pair(df_, column_names['age'][language], column_names['entry_date'][language], error_values, print_intermediate)
+        prepared = clean.prepare(df, error_values, language, column_names, print_intermediate)
+        df__ = clean.clean_column_pair(prepared, column_names['age'][language], column_names['entry_date'][language], error_values, print_intermediate)
 
         # Create tables to be exported
-        for c in columns:
-            d_tab = df__.groupby(c)[column_names['duration'][language]].agg(['sum', 'min', 'mean', 'max', 'std', 'count'])
-            output.append(d_tab)
+        with profiling.stage("groupby", df__):
+            for c in columns:
+                if cube is not None and cube.dimension(c) is not None:
+                    d_tab = cube.table([cube.dimension(c)])
+                else:
+                    d_tab = df__.groupby(c, observed=True)[column_names['duration'][language]].agg(['sum', 'min', 'mean', 'max', 'std', 'count']).sort_index()
+                output.append(d_tab)
         if print_intermediate:
             print(d_tab)
 
@@ -203,6 +231,37 @@ def timedeltas_bars_times_total(df,
         return None
 
 
+@profiling.timed()
+def timedeltas_bars_times_total_stream(filename,
+                                       columns=None,
+                                       error_values=[999],
+                                       delimiter=",",
+                                       chunksize=10**6,
+                                       language="en",
+                                       messages=MESSAGES,
+                                       column_names=clean.COLUMN_NAMES,
+                                       print_intermediate=True):
+    """
+    Same tables as timedeltas_bars_times_total, reading filename in chunks so memory stays bounded
+    columns: columns to group by
+    Output: list of dataframes, one per column
+    """
+    if columns is not None:
+        tables = clean.stream_aggregates(filename, columns, error_values, language, column_names,
+                                         delimiter, chunksize, print_intermediate)
+        output = [tables[c] for c in columns]
+
+        if print_intermediate:
+            print(output[-1])
+
+        return output
+
+    else:
+        print(messages["Error: no list of columns to chart were provided in input."][language])
+        return None
+
+
+@profiling.timed()
 def timedeltas_bars_times_by_criteria(  df,
                                         columns=None,
                                         error_values=[999],
@@ -212,43 +271,55 @@ def timedeltas_bars_times_by_criteria(  df,
                                         messages=MESSAGES,
                                         column_names=clean.COLUMN_NAMES,
                                         print_intermediate=True,
-                                        show_charts=True):
+                                        show_charts=True,
+                                        cube=None):
     """
     Show bar charts by hour, weekday, etc.
-    Criteria: list of criteria in another column
+    df: dataframe or clean.PreparedFrame
+    Criteria: list of criteria in another column, {code: name} as clean.read_departments returns or the list of clean.read_txt
+    cube: rollup.RollupCube of df, the tables are computed from it instead of the visits
     Returns a list of dataframes that can be later styled
     """
     output = []
 
     if columns is not None:
-        df_ = clean.splitdatetime(df, column_names['entry_date'][language], language, column_names, print_intermediate)
-        df__ = clean.clean_column_pair(df_, column_names['age'][language], column_names['entry_date'][language], error_values, print_intermediate)
+        prepared = clean.prepare(df, error_values, language, column_names, print_intermediate)
+        df__ = clean.clean_column_pair(prepared, column_names['age'][language], column_names['entry_date'][language], error_values, print_intermediate)
     else:
         print(messages["Error: no list of columns to chart were provided in input."][language])
 
     if criteria_name is not None and criteria is not None:
+        # Charts count the categories of the Categoricals of prepare, other columns (e.g. age) take the values of the whole frame
+        df__ = clean.as_categoricals(df__, columns)
+
+        with profiling.stage("groupby", df__):
+            # Statistics of every criteria value by weekday in a single groupby or cube query, sliced below
+            if cube is not None and cube.dimension(criteria_name) is not None:
+                tables = cube.table([cube.dimension(criteria_name), "weekday"])[['sum', 'min', 'mean', 'max', 'std']]
+            else:
+                tables = df__.groupby([criteria_name, column_names['weekday'][language]], observed=True)[column_names['duration'][language]].agg(['sum', 'min', 'mean', 'max', 'std']).sort_index()
+            # Rows of every criteria value, split in a single pass
+            subsets = {key: d_sub for key, d_sub in df__.groupby(criteria_name, sort=False, observed=True)}
 
-        # Get categories in the whole chart, not the filtered one
         for column in columns:
-            categories = [ x for x in pd.unique(pd.Series(df__[column])) ]
-            categories.sort()
+            # Categories in the whole chart, not the filtered one, kept in the chart information for the notebooks
+            categories = list(df__[column].cat.categories)
 
             # Show criteria
             if print_intermediate:
                 print(criteria_name)
                 pprint.pprint(criteria)
 
-            for c in criteria:
-                key = list(c.keys())[0]
-                value = c[key]
+            for key, value in clean.criteria_items(criteria):
+                c = {key: value}
 
                 # Don't make empty charts
-                if df__[df__[criteria_name]==key].count()[criteria_name] > 0:
+                if key in subsets:
                     if print_intermediate:
                         print("\n")
                         print(messages["Filtering by criteria:"][language]+" {0} = ({1}, {2})".format(criteria_name, key, value))
-                    d_sub = df__.loc[df__[criteria_name] == key]
-                    d_tab = d_sub.groupby([column_names['weekday'][language]])[column_names['duration'][language]].agg(['sum', 'min', 'mean', 'max', 'std'])
+                    d_sub = subsets[key]
+                    d_tab = tables.xs(key, level=0)
                     if show_charts:
                         print(d_tab)
 
@@ -268,30 +339,29 @@ def timedeltas_bars_times_by_criteria(  df,
     return output
 
 
+@profiling.timed()
 def entry_diffs( df,
                  error_values=[999],
                  language="en",
                  messages=MESSAGES,
                  column_names=clean.COLUMN_NAMES,
-                 print_intermediate=True):
+                 print_intermediate=True,
+                 arrivals=None,
+                 show_charts=True):
     """
     Show a histogram of the difference between patient i from previous patient i-1
+    df: dataframe or clean.PreparedFrame
+    arrivals: clean.InterArrivals holding the visits added so far, df is then only the new visits
+    and the histogram covers all of them; the object is updated in place
     """
-    df_ = clean.splitdatetime(df, column_names['entry_date'][language], language, column_names, print_intermediate)
-    df__ = clean.clean_column_pair(df_, column_names['age'][language], column_names['entry_date'][language], error_values, print_intermediate)
-    dts = clean.getdatetimes(df__,
-                              column_names['entry_date'][language],
-                              column_names['exit_date'][language],
-                              error_values, print_intermediate)
-    # Add converted datetimes to dateframe
-    df__[column_names['entry_date'][language]], df__[column_names['exit_date'][language]] = dts[0], dts[1]
-
+    prepared = clean.prepare(df, error_values, language, column_names, print_intermediate)
+    df__ = clean.clean_column_pair(prepared, column_names['age'][language], column_names['entry_date'][language], error_values, print_intermediate)
     # Add difference between the admission of patient i and patient i+1
-    df__ = clean.add_diff(df__, column_names['entry_date'][language], language, print_intermediate, True)
+    if arrivals is None:
+        arrivals = clean.InterArrivals()
+    arrivals.add(df__[column_names['entry_date'][language]])
 
-    intervals = [x for x in df__['delta']]
-    intervals = pd.to_numeric(intervals, errors='ignore')
-    intervals = pd.DataFrame({column_names['interval'][language]: intervals})
+    intervals = pd.DataFrame({column_names['interval'][language]: arrivals.intervals()})
     # intervals = ((1/60) * intervals / np.timedelta64(1, 's')).astype(int)
 
     if print_intermediate:
@@ -302,15 +372,13 @@ def entry_diffs( df,
         intervals.describe()
 
     bins=20
-    ax = intervals.hist(bins=bins)
-    title, xlabel, ylabel = messages["Interval between patient arrivals"][language], messages["minutes"][language], messages["patients"][language]
-    clean.customizehistogram(ax, title, xlabel, ylabel)
+    if show_charts:
+        ax = intervals.hist(bins=bins)
+        title, xlabel, ylabel = messages["Interval between patient arrivals"][language], messages["minutes"][language], messages["patients"][language]
+        clean.customizehistogram(ax, title, xlabel, ylabel)
 
-    count, divisions = np.histogram(intervals, bins=bins)
-    columns = [messages["divisions"][language], messages["count"][language]]
-    rows = list(range(bins))
-    data = np.concatenate( ([[x] for x in divisions.tolist()[1:]] , [[x] for x in count.tolist()]) , axis=1)
-    output_df = pd.DataFrame(data=data, index=rows, columns=columns)
+    histogram = arrivals.histogram(bins)
+    output_df = histogram.table([messages["divisions"][language], messages["count"][language]])
 
     if print_intermediate:
         print(messages["Histogram bins:"][language])
@@ -319,17 +387,79 @@ def entry_diffs( df,
     return output_df, intervals
 
 
-def main (language="es", messages=MESSAGES, column_names=clean.COLUMN_NAMES, print_intermediate=False):
+@profiling.timed()
+def occupancy_timeline(df,
+                       freq="1min",
+                       threshold=None,
+                       error_values=[999],
+                       criteria_name=None,
+                       language="en",
+                       messages=MESSAGES,
+                       column_names=clean.COLUMN_NAMES,
+                       print_intermediate=True,
+                       show_charts=True):
     """
-    Function returning the following output:
-    - Histograms by length of patient stay
-    - Bar charts similar to the histograms above
-    - Bar charts splitting patients by departments (several dozen of them will be generated)
-    - A dataframe with differences between the time patient i and patient i+1 arrived
-    - Another dataframe with everything
+    Patients in the X-ray unit at every freq instant, in total and by criteria_name (e.g. department)
+    df: dataframe or clean.PreparedFrame
+    threshold: if given, the time with more than threshold patients is added to the statistics
+    Returns the occupancy dataframe and a dataframe with the peak, its time and the time above threshold
+    """
+    prepared = clean.prepare(df, error_values, language, column_names, print_intermediate)
+    df__ = prepared.df
+    entries, exits = df__[column_names['entry_date'][language]], df__[column_names['exit_date'][language]]
+    total = messages["total"][language]
+
+    groups = df__[criteria_name] if criteria_name is not None else None
+    output_df = occupancy.occupancy(entries, exits, freq, groups).rename(columns={"total": total})
+
+    stats = {}
+    if criteria_name is not None:
+        for key, d_sub in sorted(df__.groupby(criteria_name, observed=True), key=lambda group: group[0]):
+            stats[key] = occupancy.occupancy_stats(d_sub[column_names['entry_date'][language]],
+                                                   d_sub[column_names['exit_date'][language]], threshold)
+    stats[total] = occupancy.occupancy_stats(entries, exits, threshold)
+    stats = pd.DataFrame.from_dict(stats, orient='index')
+
+    if print_intermediate:
+        print(stats)
+
+    if show_charts:
+        # A dataframe plot opens its own figure, a series would draw on the current one
+        ax = output_df[[total]].plot(legend=False)
+        title, xlabel, ylabel = messages["Patients in the X-ray unit"][language], messages["time"][language], messages["patients"][language]
+        clean.customizechart(ax, title, xlabel, ylabel)
+
+    return output_df, stats
+
+
+# Stages of report, in the order they run
+STAGES = ["durations", "totals", "by-department", "inter-arrival", "occupancy"]
+
+
+@profiling.timed()
+def report(stages=STAGES, language="es", messages=MESSAGES, column_names=clean.COLUMN_NAMES, print_intermediate=False,
+           cache_dir=clean.CACHE_DIR, chart_dir=None, workers=None, filename='xrays_visits.csv', show_charts=True,
+           freq="1min", threshold=None, sharded=False):
     """
+    Run the named stages on the visits in filename:
+    - durations: histogram by length of patient stay
+    - totals: duration tables and bar charts by weekday, hour, age and gender
+    - by-department: duration tables and bar charts by weekday and hour for every department
+    - inter-arrival: histogram of the time between consecutive arrivals
+    - occupancy: patients in the X-ray unit every freq, with its peak and the time above threshold
+    Matplotlib is only imported by the stages drawing charts, so show_charts=False only builds tables
+    language: clean.KEY computes on the internal column keys, the output is then labelled with relabel
+    sharded: split the visits by department for the by-department stage, chunks of departments are run by
+    workers processes (see shards.by_criteria) and the output keeps the same order
+    returns ({stage: output}, clean.PreparedFrame of the visits)
+    """
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise ValueError("Unknown stages {0}, choose from {1}".format(unknown, STAGES))
+    if language == clean.KEY:
+        messages, column_names = clean.with_keys(messages), clean.with_keys(column_names)
 
-    FILENAME = 'xrays_visits.csv'
+    FILENAME = filename
     DELIMITER = ","
     ERROR_VALUES = [999]
 
@@ -342,53 +472,278 @@ def main (language="es", messages=MESSAGES, column_names=clean.COLUMN_NAMES, pri
                  column_names["hour"][language]]
 
     COLUMN_CRITERIA = column_names["department"][language]
-    COLUMN_CRITERIA_CATEGORIES = clean.read_txt("departments.txt", print_intermediate)
+    COLUMN_CRITERIA_CATEGORIES = clean.read_departments("departments.txt", print_intermediate)
+
+    # Translate, convert from seconds to minutes, parse datetimes and add processed date fields
+    # once for every analysis below, cached between runs
+    # The sharded by-department stage computes its tables from the visits, not from the cube
+    cube = None
+    use_cube = "totals" in stages or ("by-department" in stages and not sharded)
+    if ingest.is_many(FILENAME):
+        # Many files are parsed concurrently and cached one by one
+        prepared = ingest.load_prepared(FILENAME, DELIMITER, ERROR_VALUES, language, column_names,
+                                        cache_dir, workers, print_intermediate, COLUMN_CRITERIA_CATEGORIES)
+        if use_cube:
+            cube = rollup.RollupCube(language, column_names).add(prepared, ERROR_VALUES)
+    else:
+        prepared = clean.load_prepared(FILENAME, DELIMITER, ERROR_VALUES, language, column_names,
+                                       cache_dir, False, print_intermediate, COLUMN_CRITERIA_CATEGORIES)
+        if use_cube:
+            cube = rollup.load_cube(FILENAME, DELIMITER, ERROR_VALUES, language, column_names, cache_dir, 1, prepared, print_intermediate)
+
+    if print_intermediate:
+        print(messages["Error values by column:"][language])
+        print(prepared.validity.counts())
+
+    output = {}
+
+    if "durations" in stages:
+        timedeltas_hist_times_total(prepared, ERROR_VALUES, language, messages, column_names, print_intermediate, show_charts)
+
+        # Time spent in the facility
+        output["durations"] = timedeltas_hist_bylength(prepared.exit_dates,
+                                                       prepared.entry_dates,
+                                                       language, messages, column_names, print_intermediate, show_charts)
+
+    if "totals" in stages:
+        # Totals by COLUMNS_4
+        output["totals"] = timedeltas_bars_times_total(prepared,
+                                                       COLUMNS_4,
+                                                       ERROR_VALUES,
+                                                       language, messages, column_names, print_intermediate,
+                                                       show_charts and chart_dir is None, cube)
+
+    if "by-department" in stages and sharded:
+        output["by-department"] = shards.by_criteria(prepared, COLUMNS_2, ERROR_VALUES, COLUMN_CRITERIA, COLUMN_CRITERIA_CATEGORIES,
+                                                     language, messages, column_names, workers, print_intermediate)
+        if show_charts and chart_dir is None:
+            for d_sub, title, x_axisname, y_axisname, categories, counted in render.chart_payloads(None, output["by-department"]):
+                # Same chart as clean.build_count_barchart, on the categories counted by the workers
+                if print_intermediate:
+                    print(counted)
+                ax1 = counted.plot.bar(title=title, x=x_axisname, y=y_axisname)
+                clean.customizechart(ax1, title, x_axisname, y_axisname)
+
+    elif "by-department" in stages:
+        # Charts by COLUMNS_2 by department
+        output["by-department"] = timedeltas_bars_times_by_criteria( prepared,
+                                                                     COLUMNS_2,
+                                                                     ERROR_VALUES,
+                                                                     COLUMN_CRITERIA,
+                                                                     COLUMN_CRITERIA_CATEGORIES,
+                                                                     language, messages, column_names, print_intermediate,
+                                                                     show_charts and chart_dir is None, cube)
+
+    if show_charts and chart_dir is not None and ("totals" in output or "by-department" in output):
+        render.render_charts(render.chart_payloads(output.get("totals"), output.get("by-department")),
+                             chart_dir, "png", workers, True, print_intermediate)
+
+    if "inter-arrival" in stages:
+        output["inter-arrival"] = entry_diffs(prepared, ERROR_VALUES, language, messages, column_names, print_intermediate, None, show_charts)
 
-    d = clean.convert(FILENAME, DELIMITER, print_intermediate)
+    if "occupancy" in stages:
+        output["occupancy"] = occupancy_timeline(prepared, freq, threshold, ERROR_VALUES, COLUMN_CRITERIA,
+                                                 language, messages, column_names, print_intermediate, show_charts)
 
-    d_t = clean.column_translator(d[0], language, column_names, print_intermediate)
-    # Convert from seconds to minutes
-    d_t[column_names['duration'][language]] = d_t[column_names['duration'][language]].div(60)
+    return output, prepared
 
-    # Add processed date fields
-    df1 = clean.getdatetimes(d_t,
-                             column_names['entry_date'][language],
-                             column_names['exit_date'][language],
-                             ERROR_VALUES, print_intermediate)
 
-    timedeltas_hist_times_total(d_t, ERROR_VALUES, language, messages, column_names, print_intermediate)
+def relabel(output, language="en", messages=MESSAGES, column_names=clean.COLUMN_NAMES):
+    """
+    Label the output of report computed with language=clean.KEY in language
+    Only names and titles are built, the tables and dataframes share their data with output
+    """
+    # Column names everywhere, messages only in the histogram tables whose columns are messages
+    mapping = clean.labels(language, column_names)
+    texts = clean.labels(language, column_names, messages)
+    frames = {}
+
+    def frame(df):
+        # The same dataframe (e.g. the visits of every chart) is only relabelled once
+        if id(df) not in frames:
+            frames[id(df)] = clean.relabel_frame(df, mapping)
+        return frames[id(df)]
+
+    labelled = {}
+    for stage in ["durations", "inter-arrival"]:
+        if stage in output:
+            labelled[stage] = tuple(clean.relabel_frame(df, texts) for df in output[stage])
+
+    if "totals" in output:
+        labelled["totals"] = None
+        if output["totals"] is not None:
+            tables, histograms_info = output["totals"]
+            labelled["totals"] = ([frame(d_tab) for d_tab in tables],
+                                  [[frame(df__), messages["All patients by "][language] + mapping[column], mapping[column],
+                                    messages["patients"][language]] for df__, title, column, y_axisname in histograms_info])
+
+    if "by-department" in output:
+        labelled["by-department"] = []
+        for criteria_name, c, d_tab, (d_sub, title, column, y_axisname, categories, *counted) in output["by-department"]:
+            key, value = list(c.items())[0]
+            title = "{0} {1}: {2} by {3}".format(mapping[criteria_name].capitalize(), key, value, mapping[column])
+            # Counted categories of the sharded mode, see shards.by_criteria
+            counted = [clean.relabel_frame(df, texts) for df in counted]
+            labelled["by-department"].append([mapping[criteria_name], c, frame(d_tab),
+                                              [frame(d_sub), title, mapping[column], messages["patients"][language], categories] + counted])
+
+    if "occupancy" in output:
+        output_df, stats = output["occupancy"]
+        total = {"total": messages["total"][language]}
+        labelled["occupancy"] = (output_df.rename(columns=total, copy=False), stats.rename(index=total, copy=False))
+
+    return labelled
+
+
+@profiling.timed()
+def reports(languages=["es", "en"], stages=STAGES, messages=MESSAGES, column_names=clean.COLUMN_NAMES, print_intermediate=False,
+            cache_dir=clean.CACHE_DIR, chart_dir=None, workers=None, filename='xrays_visits.csv', freq="1min", threshold=None,
+            sharded=False):
+    """
+    Run report once on the internal column keys and label its output in every language
+    chart_dir: if given, the bar charts of every language are saved in chart_dir/language
+    returns ({language: {stage: output}}, clean.PreparedFrame of the visits with the internal column keys)
+    """
+    output, prepared = report(stages, clean.KEY, messages, column_names, print_intermediate,
+                              cache_dir, None, workers, filename, False, freq, threshold, sharded)
 
-    # Time spent in the facility
-    histo_lbl = timedeltas_hist_bylength(df1[1],
-                                         df1[0],
-                                         language, messages, column_names, print_intermediate)
+    labelled = {}
+    for language in languages:
+        labelled[language] = relabel(output, language, messages, column_names)
+        if chart_dir is not None and ("totals" in output or "by-department" in output):
+            render.render_charts(render.chart_payloads(labelled[language].get("totals"), labelled[language].get("by-department")),
+                                 os.path.join(chart_dir, language), "png", workers, True, print_intermediate)
 
-    # Totals by COLUMNS_4
-    tables_totals = timedeltas_bars_times_total(d_t,
-                                                COLUMNS_4,
-                                                ERROR_VALUES,
-                                                language, messages, column_names, print_intermediate)
+    return labelled, prepared
 
-    # Charts by COLUMNS_2 by department
-    tables_by_criteria = timedeltas_bars_times_by_criteria( d_t,
-                                                            COLUMNS_2,
-                                                            ERROR_VALUES,
-                                                            COLUMN_CRITERIA,
-                                                            COLUMN_CRITERIA_CATEGORIES,
-                                                            language, messages, column_names, print_intermediate)
+
+def write_tables(output, directory="report"):
+    """
+    Write the tables returned by report to csv files in directory, one per table
+    returns the list of files
+    """
+    tables = []
+    if "durations" in output:
+        tables.append(("durations", output["durations"][0]))
+    if output.get("totals") is not None:
+        for d_tab in output["totals"][0]:
+            tables.append(("totals.{0}".format(d_tab.index.name), d_tab))
+    for criteria_name, c, d_tab, histogram_info in output.get("by-department", []):
+        tables.append(("by-department.{0}".format(list(c.keys())[0]), d_tab))
+    if "inter-arrival" in output:
+        tables.append(("inter-arrival", output["inter-arrival"][0]))
+    if "occupancy" in output:
+        tables.append(("occupancy", output["occupancy"][0]))
+        tables.append(("occupancy.stats", output["occupancy"][1]))
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, d_tab in tables:
+        path = os.path.join(directory, name + ".csv")
+        d_tab.to_csv(path)
+        paths.append(path)
+    return paths
+
+
+@profiling.timed()
+def main (language="es", messages=MESSAGES, column_names=clean.COLUMN_NAMES, print_intermediate=False, cache_dir=clean.CACHE_DIR,
+          chart_dir=None, workers=None, filename='xrays_visits.csv', show_charts=True):
+    """
+    Function returning the following output:
+    - Histograms by length of patient stay
+    - Bar charts similar to the histograms above
+    - Bar charts splitting patients by departments (several dozen of them will be generated)
+    - A dataframe with differences between the time patient i and patient i+1 arrived
+    - Another dataframe with everything
+    cache_dir: directory where the prepared dataframe is cached, None to always read the csv
+    chart_dir: if given, bar charts are saved there by worker processes instead of being shown
+    filename: csv with the visits, or a glob pattern or list of csv files read with ingest.load_visits
+    show_charts: False to only compute the tables
+    Stages can be timed by running it inside a profiling.Instrument:
+        with profiling.Instrument(sinks=[profiling.jsonl_sink("stages.jsonl")]) as instrument:
+            main()
+    report runs only some of the stages, cli from the command line
+    """
+    output, prepared = report(["durations", "totals", "by-department", "inter-arrival"], language, messages, column_names,
+                              print_intermediate, cache_dir, chart_dir, workers, filename, show_charts)
+    d_t = prepared.df
 
     weekdays = [1, 2, 3, 4, 7]
     hours = [8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18]
-    try:
-        d_t.dia_semana.isin(weekdays)
-        d_t.hora.isin(hours)
-    except:
-        d_t.weekday.isin(weekdays)
-        d_t.hour.isin(hours)
+    d_t[column_names["weekday"][language]].isin(weekdays)
+    d_t[column_names["hour"][language]].isin(hours)
+
+    return (output["durations"], output["totals"], output["by-department"], output["inter-arrival"], d_t)
 
-    diffs = entry_diffs(d_t, ERROR_VALUES, language, messages, column_names, print_intermediate)
 
-    return (histo_lbl, tables_totals, tables_by_criteria, diffs, d_t)
+def cli(argv=None):
+    """
+    Command line: run some stages of report and write their tables (and charts) to the output directory, e.g.
+        python main.py --stages totals by-department --language en --input "visits/*.csv" --output report
+    """
+    parser = argparse.ArgumentParser(description="Reports of the visits to the X-ray unit")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--language", nargs="+", choices=["es", "en"], default=["es"],
+                        help="several languages are computed once and written to OUTPUT/language")
+    parser.add_argument("--input", nargs="+", default=["xrays_visits.csv"], help="csv files or glob patterns")
+    parser.add_argument("--output", default="report", help="directory for the tables and charts")
+    parser.add_argument("--charts", action="store_true", help="save the charts in OUTPUT/charts")
+    parser.add_argument("--cache-dir", default=clean.CACHE_DIR)
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--sharded", action="store_true", help="run the by-department stage one department per worker")
+    parser.add_argument("--freq", default="1min", help="instants of the occupancy stage")
+    parser.add_argument("--threshold", type=int, default=None, help="patients above which the occupancy stage measures time")
+    parser.add_argument("--export", action="store_true",
+                        help="also write every table and the cleaned visits as Parquet datasets in OUTPUT/tables and OUTPUT/visits")
+    parser.add_argument("--excel", action="store_true", help="with --export, also write the tables to OUTPUT/report.xlsx")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    filename = args.input[0] if len(args.input) == 1 else args.input
+    chart_dir = os.path.join(args.output, "charts") if args.charts else None
+    if args.charts:
+        # Only imported when charts are requested, without an interactive backend
+        import matplotlib
+        matplotlib.use("Agg")
+
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    if len(args.language) > 1:
+        # Only the bar charts are drawn, once per language
+        labelled, prepared = reports(args.language, args.stages, MESSAGES, clean.COLUMN_NAMES, args.verbose,
+                                     cache_dir, chart_dir, args.workers, filename, args.freq, args.threshold, args.sharded)
+        paths = []
+        for language, output in labelled.items():
+            paths.extend(write_tables(output, os.path.join(args.output, language)))
+            if args.export:
+                visits = clean.relabel_frame(prepared.df, clean.labels(language, clean.COLUMN_NAMES))
+                paths.extend(export.export(output, os.path.join(args.output, language), language, MESSAGES, clean.COLUMN_NAMES,
+                                           visits, args.excel, args.verbose))
+        print("Wrote {0} files to {1}".format(len(paths), args.output))
+        return 0
+
+    output, prepared = report(args.stages, args.language[0], MESSAGES, clean.COLUMN_NAMES, args.verbose,
+                              cache_dir, chart_dir, args.workers, filename, args.charts, args.freq, args.threshold, args.sharded)
+    paths = write_tables(output, args.output)
+    if args.export:
+        paths.extend(export.export(output, args.output, args.language[0], MESSAGES, clean.COLUMN_NAMES, prepared.df, args.excel, args.verbose))
+
+    if args.charts:
+        # Histograms and the occupancy chart are drawn with pandas, the bar charts were saved by render
+        import matplotlib.pyplot as plt
+        os.makedirs(chart_dir, exist_ok=True)
+        for i, number in enumerate(plt.get_fignums()):
+            figure = plt.figure(number)
+            title = " ".join(ax.get_title() for ax in figure.axes)
+            path = os.path.join(chart_dir, render.chart_filename(i, "figure " + title))
+            figure.savefig(path)
+            paths.append(path)
+        plt.close("all")
+
+    print("Wrote {0} files to {1}".format(len(paths), args.output))
+    return 0
+
 
 if __name__ == '__main__':
-    main()
+    sys.exit(cli())
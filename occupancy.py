@@ -0,0 +1,143 @@
+import pandas as pd
+import numpy as np
+
+import profiling
+
+
+def _nanoseconds(dates):
+    """
+    int64 nanoseconds of a series or array of datetimes, NaT as the minimum int64
+    """
+    return np.asarray(pd.to_datetime(pd.Series(dates)).to_numpy(dtype="datetime64[ns]")).view(np.int64)
+
+
+def _valid(entries, exits):
+    """
+    Drop visits without entry or exit and visits that leave before they arrive
+    """
+    nat = np.iinfo(np.int64).min
+    keep = (entries != nat) & (exits != nat) & (exits >= entries)
+    return keep
+
+
+def occupancy_steps(entries, exits):
+    """
+    Sweep over the sorted entries and exits of the visits
+    A patient is present from entry (included) to exit (excluded)
+    returns (times, levels): the patients present from times[i] until times[i+1]
+    """
+    entries, exits = _nanoseconds(entries), _nanoseconds(exits)
+    keep = _valid(entries, exits)
+    entries, exits = entries[keep], exits[keep]
+
+    # Net change at every distinct time, so a patient leaving and another arriving at once doesn't create a step
+    times, inverse = np.unique(np.concatenate([entries, exits]), return_inverse=True)
+    changes = np.bincount(inverse, weights=np.concatenate([np.ones(len(entries)), -np.ones(len(exits))]), minlength=len(times))
+    levels = np.cumsum(changes).astype(np.int64)
+
+    return times.view("datetime64[ns]"), levels
+
+
+def occupancy_stats(entries, exits, threshold=None):
+    """
+    Peak occupancy, when it was first reached and, if threshold is given, total time with more than threshold patients
+    Computed exactly on the sweep, not on a resampled series
+    """
+    times, levels = occupancy_steps(entries, exits)
+    if len(levels) == 0:
+        return {"peak": 0, "peak_time": pd.NaT, "time_above": pd.Timedelta(0)}
+
+    output = {"peak": int(levels.max()), "peak_time": pd.Timestamp(times[levels.argmax()])}
+    if threshold is not None:
+        lengths = np.diff(times.view(np.int64))
+        output["time_above"] = pd.Timedelta(int(lengths[levels[:-1] > threshold].sum()), unit="ns")
+    return output
+
+
+class OccupancyGrid:
+    """
+    Patients present at every instant start, start + freq, ... before end, overall and by group
+    Visits can be added in chunks and grids with the same instants merged, so input can be streamed
+    groups: keys of the groups (e.g. department codes), None to count only the total
+    """
+    def __init__(self, start, end, freq="1min", groups=None):
+        self.start = pd.Timestamp(start).floor(freq)
+        self.step = pd.Timedelta(freq).value
+        self.size = int(np.ceil((pd.Timestamp(end).value - self.start.value) / self.step))
+        self.freq = freq
+        self.groups = list(groups) if groups is not None else []
+        self._codes = {key: i for i, key in enumerate(self.groups)}
+        # Difference arrays: +1 at the first instant a visit is present, -1 at the first instant it isn't
+        self.changes = np.zeros((len(self.groups) + 1, self.size + 1), dtype=np.int64)
+
+    def _positions(self, dates):
+        positions = -(-(dates - self.start.value) // self.step)
+        return np.clip(positions, 0, self.size)
+
+    def add(self, entries, exits, groups=None):
+        """
+        Add visits, groups is the group key of every visit (required if the grid has groups)
+        """
+        entries, exits = _nanoseconds(entries), _nanoseconds(exits)
+        keep = _valid(entries, exits)
+        first, last = self._positions(entries[keep]), self._positions(exits[keep])
+
+        self.changes[-1] += np.bincount(first, minlength=self.size + 1) - np.bincount(last, minlength=self.size + 1)
+        if self.groups:
+            codes = pd.Series(np.asarray(groups)[keep]).map(self._codes)
+            known = codes.notna().to_numpy()
+            codes = codes[known].to_numpy(dtype=np.int64)
+            width = self.size + 1
+            self.changes[:-1] += (np.bincount(codes * width + first[known], minlength=len(self.groups) * width)
+                                  - np.bincount(codes * width + last[known], minlength=len(self.groups) * width)
+                                  ).reshape(len(self.groups), width)
+        return self
+
+    def merge(self, other):
+        """
+        Add the visits of another grid with the same instants and groups
+        """
+        if (self.start, self.step, self.size, self.groups) != (other.start, other.step, other.size, other.groups):
+            raise ValueError("Occupancy grids with different instants or groups can't be merged")
+        self.changes += other.changes
+        return self
+
+    def series(self, total_name="total"):
+        """
+        Returns a dataframe indexed by instant, with a column per group and one with the total
+        """
+        counts = np.cumsum(self.changes[:, :-1], axis=1)
+        index = pd.date_range(self.start, periods=self.size, freq=self.freq)
+        return pd.DataFrame(counts.T, index=index, columns=self.groups + [total_name])
+
+
+@profiling.timed()
+def occupancy(entries, exits, freq="1min", groups=None, start=None, end=None):
+    """
+    Patients present at every freq instant between the first entry and the last exit (or start and end)
+    groups: optional key of every visit, adds a column per key
+    returns a dataframe indexed by instant
+    """
+    entries, exits = pd.Series(pd.to_datetime(entries)).reset_index(drop=True), pd.Series(pd.to_datetime(exits)).reset_index(drop=True)
+    start = entries.min() if start is None else start
+    end = exits.max() + pd.Timedelta(freq) if end is None else end
+    keys = None
+    if groups is not None:
+        groups = pd.Series(groups).reset_index(drop=True)
+        keys = sorted(groups.dropna().unique())
+
+    grid = OccupancyGrid(start, end, freq, keys)
+    grid.add(entries, exits, groups)
+    return grid.series()
+
+
+@profiling.timed()
+def stream_occupancy(chunks, entry_name, exit_name, start, end, freq="1min", group_name=None, groups=None):
+    """
+    Occupancy of visits read chunk by chunk, e.g. from clean.convert_chunks or scenarios.load_scenario
+    Only the grid is kept in memory, so start, end and the groups have to be known in advance
+    """
+    grid = OccupancyGrid(start, end, freq, groups)
+    for chunk in chunks:
+        grid.add(chunk[entry_name], chunk[exit_name], chunk[group_name] if group_name is not None else None)
+    return grid.series()
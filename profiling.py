@@ -0,0 +1,174 @@
+import os, time, json, logging, functools, resource, tracemalloc, cProfile
+
+import pandas as pd
+
+# Instrument receiving the stages being run, set by Instrument.__enter__
+_active = None
+
+
+def logging_sink(logger=None, level=logging.INFO):
+    """
+    Returns a sink writing every stage record to logger
+    """
+    logger = logger or logging.getLogger("technion")
+
+    def sink(record):
+        logger.log(level, "%s", json.dumps(record, default=str))
+    return sink
+
+
+def jsonl_sink(filename):
+    """
+    Returns a sink appending every stage record as a line of json to filename
+    """
+    def sink(record):
+        with open(filename, "a") as file:
+            file.write(json.dumps(record, default=str) + "\n")
+    return sink
+
+
+def count_rows(obj):
+    """
+    Rows of a dataframe, series, PreparedFrame or of the first element of a tuple or list, None otherwise
+    """
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return len(obj)
+    if hasattr(obj, "df") and isinstance(obj.df, pd.DataFrame):
+        return len(obj.df)
+    if isinstance(obj, (tuple, list)) and len(obj) > 0 and not isinstance(obj[0], (tuple, list)):
+        return count_rows(obj[0])
+    return None
+
+
+class Instrument:
+    """
+    Collects the wall time, rows in/out and memory of every stage run while it is active:
+        with Instrument(sinks=[jsonl_sink("stages.jsonl")]) as instrument:
+            main.main(...)
+        instrument.report()
+    sinks: functions receiving every record (a dictionary) when its stage ends
+    trace_memory: measure the peak of memory allocated by Python during each stage with tracemalloc (slower)
+    profile_dir: if given, stages are profiled with cProfile and their stats saved there
+    profile_stages: names of the stages to profile, None for the outermost ones
+    """
+    def __init__(self, sinks=None, trace_memory=False, profile_dir=None, profile_stages=None):
+        self.sinks = list(sinks) if sinks is not None else []
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.profile_stages = profile_stages
+        self.records = []
+        self._stack = []
+        self._previous = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        global _active
+        self._previous, _active = _active, self
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self._previous
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+
+    def start(self, name, rows_in=None):
+        """
+        Open a stage, returns its record
+        """
+        record = {"stage": name, "depth": len(self._stack), "rows_in": rows_in, "rows_out": None}
+        if self.trace_memory:
+            # The peak so far belongs to the stage that contains this one
+            peak = tracemalloc.get_traced_memory()[1]
+            if self._stack:
+                self._stack[-1]["_peak"] = max(self._stack[-1]["_peak"], peak)
+            tracemalloc.reset_peak()
+            record["_peak"] = 0
+        # Profilers can't be nested, stages inside a profiled one are only timed
+        if self.profile_dir is not None and (self.profile_stages is None or name in self.profile_stages) \
+                and not any("_profile" in r for r in self._stack):
+            record["_profile"] = cProfile.Profile()
+            record["_profile"].enable()
+        self._stack.append(record)
+        record["_start"] = time.perf_counter()
+        return record
+
+    def stop(self, record, rows_out=None):
+        """
+        Close the stage of record and send it to the sinks
+        """
+        record["seconds"] = time.perf_counter() - record.pop("_start")
+        record["rows_out"] = rows_out
+        self._stack.remove(record)
+
+        if "_profile" in record:
+            profile = record.pop("_profile")
+            profile.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            record["profile"] = os.path.join(self.profile_dir, "{0:03d}_{1}.prof".format(len(self.records), record["stage"]))
+            profile.dump_stats(record["profile"])
+        if "_peak" in record:
+            record["peak_bytes"] = max(record.pop("_peak"), tracemalloc.get_traced_memory()[1])
+            if self._stack:
+                self._stack[-1]["_peak"] = max(self._stack[-1]["_peak"], record["peak_bytes"])
+        # Peak resident memory of the whole process so far, in kilobytes on Linux
+        record["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        self.records.append(record)
+        for sink in self.sinks:
+            sink(record)
+        return record
+
+    def report(self):
+        """
+        Returns a dataframe with a row per stage, in the order they finished
+        """
+        return pd.DataFrame(self.records)
+
+
+class stage:
+    """
+    Context manager timing a block as a stage of the active Instrument, if there is one
+        with profiling.stage("groupby", df) as s:
+            ...
+            s.rows_out = len(result)
+    """
+    def __init__(self, name, df=None):
+        self.name = name
+        self.rows_in = count_rows(df)
+        self.rows_out = None
+        self.record = None
+
+    def __enter__(self):
+        if _active is not None:
+            self.instrument = _active
+            self.record = self.instrument.start(self.name, self.rows_in)
+        return self
+
+    def __exit__(self, *exc):
+        if self.record is not None:
+            self.instrument.stop(self.record, self.rows_out)
+        return False
+
+
+def timed(name=None):
+    """
+    Decorator making every call of a function a stage of the active Instrument
+    rows in and out are taken from the first argument and from the result
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+            with stage(name or function.__name__, args[0] if args else None) as s:
+                result = function(*args, **kwargs)
+                s.rows_out = count_rows(result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,112 @@
+import os, re, json, hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import clean
+import profiling
+
+MANIFEST = "charts.json"
+
+
+def chart_payloads(tables_totals=None, tables_by_criteria=None):
+    """
+    Collect the chart information returned by main.timedeltas_bars_times_total and main.timedeltas_bars_times_by_criteria
+    returns a list of [df, title, x_axisname, y_axisname, categories] and, if the categories were already counted
+    (see shards.by_criteria), the counted dataframe
+    """
+    payloads = []
+    if tables_totals is not None:
+        for histogram_info in tables_totals[1]:
+            payloads.append(list(histogram_info[:4]) + [None])
+    if tables_by_criteria is not None:
+        for item in tables_by_criteria:
+            payloads.append(list(item[3]))
+    return payloads
+
+
+def chart_filename(i, title, file_format="png"):
+    """
+    File name of the i-th chart, built from its title
+    """
+    slug = re.sub(r"[^0-9A-Za-z]+", "_", title).strip("_").lower()
+    return "{0:03d}_{1}.{2}".format(i, slug, file_format)
+
+
+def chart_digest(df_sub, title, x_axisname, y_axisname, file_format="png"):
+    """
+    Hash of everything drawn in a chart, used to skip charts that haven't changed
+    """
+    digest = hashlib.sha1()
+    digest.update(pd.util.hash_pandas_object(df_sub, index=False).values.tobytes())
+    digest.update(json.dumps([title, x_axisname, y_axisname, file_format]).encode())
+    return digest.hexdigest()
+
+
+def render_chart(df_sub, title, x_axisname, y_axisname, path):
+    """
+    Draw a bar chart from counted categories and save it to path, without an interactive backend
+    """
+    # A bare Figure is drawn with Agg (or the svg/pdf canvas) whatever backend pyplot uses
+    from matplotlib.figure import Figure
+
+    figure = Figure()
+    ax1 = figure.subplots()
+    df_sub.plot.bar(ax=ax1, title=title, x=x_axisname, y=y_axisname)
+    clean.customizechart(ax1, title, x_axisname, y_axisname)
+    figure.savefig(path, bbox_inches="tight")
+    return path
+
+
+def _render_chart(args):
+    """
+    Unpack the arguments of render_chart, used by the process pool
+    """
+    return render_chart(*args)
+
+
+@profiling.timed()
+def render_charts(payloads, output_dir="charts", file_format="png", workers=None, skip_unchanged=True, print_intermediate=True):
+    """
+    Save the bar charts described in payloads (see chart_payloads) as png or svg files in output_dir
+    The categories are counted here unless the payload has them counted, so only the small count tables
+    are sent to the worker processes
+    workers: number of processes, None for one per core, 1 to render in this process
+    skip_unchanged: don't render again charts whose data and labels are the same as in the previous run
+    returns the list of paths of the charts
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    manifest = {}
+    if skip_unchanged and os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+
+    paths, pending, digests = [], [], {}
+    for i, payload in enumerate(payloads):
+        df, title, x_axisname, y_axisname, categories, counted = (list(payload) + [None, None])[:6]
+        df_sub = counted if counted is not None else clean.count_categories(df, x_axisname, y_axisname, categories)
+
+        name = chart_filename(i, title, file_format)
+        path = os.path.join(output_dir, name)
+        paths.append(path)
+        digests[name] = chart_digest(df_sub, title, x_axisname, y_axisname, file_format)
+
+        if skip_unchanged and manifest.get(name) == digests[name] and os.path.exists(path):
+            continue
+        pending.append((df_sub, title, x_axisname, y_axisname, path))
+
+    if print_intermediate:
+        print("Rendering {0} of {1} charts in {2}".format(len(pending), len(payloads), output_dir))
+
+    if workers == 1 or len(pending) < 2:
+        for args in pending:
+            _render_chart(args)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_render_chart, pending, chunksize=max(1, len(pending) // (4 * (workers or os.cpu_count() or 1)))))
+
+    with open(manifest_path, "w") as file:
+        json.dump(digests, file, indent=1, sort_keys=True)
+
+    return paths
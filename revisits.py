@@ -0,0 +1,145 @@
+import pandas as pd
+import numpy as np
+
+import clean
+import profiling
+
+NAT = np.iinfo(np.int64).min
+NANOSECONDS_PER_HOUR = 3600 * 10**9
+# patient_id is not translated by clean.column_translator
+PATIENT_ID = "patient_id"
+
+
+class PatientIndex:
+    """
+    Visits sorted by patient and entry date, built once so that every patient level question is answered
+    with diffs and searchsorted over the sorted arrays instead of a loop over the patients
+    patients, dates and departments: one value per visit; visits without an entry date are left out
+    """
+    def __init__(self, patients, dates, departments=None):
+        patients = np.asarray(patients, dtype=np.int64)
+        times = pd.to_datetime(pd.Series(dates)).to_numpy(dtype="datetime64[ns]").view(np.int64)
+        keep = np.flatnonzero(times != NAT)
+
+        order = keep[np.lexsort([times[keep], patients[keep]])]
+        # Position of every sorted visit in the original rows
+        self.order = order
+        self.patients = patients[order]
+        self.times = times[order]
+        self.departments = None if departments is None else np.asarray(departments, dtype=np.float64)[order].astype(np.int64)
+
+        # same[i]: visits i and i+1 belong to the same patient
+        self.same = self.patients[1:] == self.patients[:-1]
+        self.starts = np.flatnonzero(np.concatenate([[True], ~self.same])) if len(order) > 0 else np.zeros(0, dtype=np.int64)
+        self.ids = self.patients[self.starts]
+        self.counts = np.diff(np.append(self.starts, len(order)))
+
+    def __len__(self):
+        return len(self.order)
+
+    def visit_counts(self):
+        """
+        Number of visits of every patient, as a series indexed by patient_id
+        """
+        return pd.Series(self.counts, index=pd.Index(self.ids, name=PATIENT_ID), name="visits")
+
+    def find(self, patient_ids):
+        """
+        First position and number of the sorted visits of every patient in patient_ids, 0 visits for unknown patients
+        returns (starts, counts)
+        """
+        patient_ids = np.asarray(patient_ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.zeros(len(patient_ids), dtype=np.int64), np.zeros(len(patient_ids), dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, patient_ids), len(self.ids) - 1)
+        found = self.ids[positions] == patient_ids
+        return np.where(found, self.starts[positions], 0), np.where(found, self.counts[positions], 0)
+
+    def gaps(self):
+        """
+        Hours between every visit and the next visit of the same patient
+        returns (positions of the earlier visits in the sorted order, hours)
+        """
+        earlier = np.flatnonzero(self.same)
+        hours = (self.times[earlier + 1] - self.times[earlier]) / NANOSECONDS_PER_HOUR
+        return earlier, hours
+
+    def revisits(self, hours):
+        """
+        True for every sorted visit followed by another visit of the same patient at most hours later
+        """
+        earlier, gaps = self.gaps()
+        revisit = np.zeros(len(self), dtype=bool)
+        revisit[earlier] = gaps <= hours
+        return revisit
+
+
+@profiling.timed()
+def patient_index(df, error_values=[999], language="en", column_names=clean.COLUMN_NAMES, print_intermediate=True):
+    """
+    PatientIndex of the visits in df, without the error values in patient_id
+    df: dataframe or clean.PreparedFrame
+    """
+    prepared = clean.prepare(df, error_values, language, column_names, False)
+    d = clean.clean_column_pair(prepared, PATIENT_ID, None, error_values, False)
+    index = PatientIndex(d[PATIENT_ID], d[column_names['entry_date'][language]],
+                         d[column_names['department'][language]])
+
+    if print_intermediate:
+        print("\n{0} visits of {1} patients, {2} with more than one visit".format(
+            len(index), len(index.ids), int((index.counts > 1).sum())))
+
+    return index
+
+
+def visit_counts(index):
+    """
+    Number of visits of every patient and number of patients with every number of visits
+    index: PatientIndex, see patient_index
+    returns (visits by patient, patients by number of visits)
+    """
+    visits = index.visit_counts()
+    patients = pd.Series(np.bincount(index.counts, minlength=1), name="patients").rename_axis("visits")
+    return visits, patients[patients > 0]
+
+
+def time_between_visits(index, language="en", column_names=clean.COLUMN_NAMES):
+    """
+    Hours between the consecutive visits of every patient
+    index: PatientIndex, see patient_index
+    returns a dataframe with the patient, the department of the earlier visit, its entry date and the hours until the next one
+    """
+    earlier, hours = index.gaps()
+    output = pd.DataFrame({PATIENT_ID: index.patients[earlier],
+                           column_names['entry_date'][language]: index.times[earlier].view("datetime64[ns]"),
+                           "hours": hours})
+    if index.departments is not None:
+        output.insert(1, column_names['department'][language], index.departments[earlier])
+    return output
+
+
+@profiling.timed()
+def revisit_rates(index, hours=[24, 72], language="en", column_names=clean.COLUMN_NAMES, print_intermediate=True):
+    """
+    Share of the visits followed by another visit of the same patient within each number of hours,
+    by the department of the earlier visit
+    index: PatientIndex, see patient_index
+    returns a dataframe indexed by department with visits and, for every value of hours, revisits_<hours>h and rate_<hours>h;
+    a single total row if index has no departments
+    """
+    if index.departments is None:
+        codes, departments = np.zeros(len(index), dtype=np.int64), pd.Index(["total"])
+    else:
+        codes, departments = pd.factorize(index.departments, sort=True)
+        departments = pd.Index(departments, name=column_names['department'][language])
+    visits = np.bincount(codes, minlength=len(departments))
+    output = pd.DataFrame({"visits": visits}, index=departments)
+    for h in hours:
+        revisits = np.bincount(codes, weights=index.revisits(h), minlength=len(departments)).astype(np.int64)
+        output["revisits_{0}h".format(h)] = revisits
+        output["rate_{0}h".format(h)] = revisits / np.where(visits > 0, visits, 1)
+
+    if print_intermediate:
+        print(output)
+
+    return output
@@ -0,0 +1,270 @@
+import os
+
+import pandas as pd
+import numpy as np
+
+import clean
+import profiling
+
+# Dimensions of the cube, keys of clean.COLUMN_NAMES; entry_day is the day of the entry date
+DIMENSIONS = ["entry_day", "hour", "weekday", "department", "gender", "age"]
+MEASURES = ["count", "sum", "m2", "min", "max"]
+# Coarser aggregates kept next to the cells, which hold about one cell per visit: queries on their dimensions
+# (e.g. arrivals by hour for department 53 on Mondays, or the tables of main.py) only reduce a few thousand rows
+ROLLUPS = [("department", "weekday", "hour"), ("gender", "age")]
+NAT = np.iinfo(np.int64).min
+# Largest number of key combinations grouped with a dense array instead of a sort
+DENSE_CELLS = 2**22
+
+
+def _group(keys, size):
+    """
+    Group size rows by several integer key arrays, all rows are a single group without keys
+    returns (first row of every group, group of every row), groups sorted by the keys
+    """
+    if not keys:
+        return np.zeros(min(size, 1), dtype=np.int64), np.zeros(size, dtype=np.int64)
+    shape = tuple(int(k.max()) + 1 for k in keys) if size > 0 and min(k.min() for k in keys) >= 0 else None
+    if shape is not None and np.prod(shape, dtype=np.float64) < 2**62:
+        # Non-negative keys are combined in a single code, sorted in the order of the keys
+        code = np.ravel_multi_index(keys, shape)
+        if np.prod(shape, dtype=np.float64) <= DENSE_CELLS:
+            # Few combinations (e.g. department, weekday and hour) are numbered by their position in a dense array
+            present = np.flatnonzero(np.bincount(code))
+            lookup = np.zeros(code.max() + 1, dtype=np.int64)
+            lookup[present] = np.arange(len(present))
+            groups = lookup[code]
+            first = np.empty(len(present), dtype=np.int64)
+            # The last assignment wins, so in reverse every group keeps its first row
+            first[groups[::-1]] = np.arange(size - 1, -1, -1)
+            return first, groups
+        order = np.argsort(code, kind="stable")
+        starts = np.empty(size, dtype=bool)
+        starts[:1] = True
+        code = code[order]
+        starts[1:] = code[1:] != code[:-1]
+    else:
+        order = np.lexsort(keys[::-1])
+        starts = np.zeros(size, dtype=bool)
+        starts[:1] = True
+        for k in keys:
+            k = k[order]
+            starts[1:] |= k[1:] != k[:-1]
+    groups = np.empty(size, dtype=np.int64)
+    groups[order] = np.cumsum(starts) - 1
+    return order[starts], groups
+
+
+def _reduce(keys, measures):
+    """
+    Combine the measures of the cells with the same keys
+    m2 (sum of squared deviations from the mean) is merged with the group means, which keeps it exact
+    returns (keys, measures) of the combined cells
+    """
+    first, groups = _group(keys, len(measures["count"]))
+    size = len(first)
+    count = np.bincount(groups, weights=measures["count"], minlength=size)
+    total = np.bincount(groups, weights=measures["sum"], minlength=size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+        cell_mean = measures["sum"] / measures["count"]
+    deviation = np.where(measures["count"] > 0, cell_mean - mean[groups], 0)
+    m2 = np.bincount(groups, weights=measures["m2"] + measures["count"] * deviation ** 2, minlength=size)
+
+    minimum = np.full(size, np.inf)
+    np.minimum.at(minimum, groups, measures["min"])
+    maximum = np.full(size, -np.inf)
+    np.maximum.at(maximum, groups, measures["max"])
+
+    output = {"count": count.astype(np.int64), "sum": total, "m2": m2, "min": minimum, "max": maximum}
+    return [k[first] for k in keys], output
+
+
+class RollupCube:
+    """
+    Count and duration count, sum, m2, min and max of the visits by entry day, hour, weekday, department,
+    gender and age band, so that tables are computed from the cells instead of the visits
+    Visits can be added incrementally and cubes merged; cells are kept as sorted NumPy arrays, and so are the
+    rollups of ROLLUPS, updated with them and used by queries on their dimensions
+    age_band: width of the age bands, 1 keeps the ages
+    """
+    def __init__(self, language="en", column_names=clean.COLUMN_NAMES, age_band=1):
+        self.language = language
+        self.column_names = column_names
+        self.age_band = age_band
+        self.keys = {d: np.empty(0, dtype=np.int64) for d in DIMENSIONS}
+        self.measures = {m: np.empty(0, dtype=np.int64 if m == "count" else np.float64) for m in MEASURES}
+        self.rollups = {rollup: ({d: self.keys[d] for d in rollup}, self.measures) for rollup in ROLLUPS}
+
+    def __len__(self):
+        return len(self.measures["count"])
+
+    def name(self, dimension):
+        """
+        Translated column name of a dimension
+        """
+        return self.column_names[dimension][self.language]
+
+    def dimension(self, column_name):
+        """
+        Dimension of a translated column name, None if the cube doesn't have it
+        Ages are only a dimension if the bands keep them
+        """
+        for dimension in DIMENSIONS:
+            if self.name(dimension) == column_name and (dimension != "age" or self.age_band == 1):
+                return dimension
+        return None
+
+    def _combine(self, keys, measures):
+        keys = dict(zip(DIMENSIONS, keys))
+        for rollup, (rollup_keys, rollup_measures) in self.rollups.items():
+            reduced = _reduce([np.concatenate([rollup_keys[d], keys[d]]) for d in rollup],
+                              {m: np.concatenate([rollup_measures[m], measures[m]]) for m in MEASURES})
+            self.rollups[rollup] = (dict(zip(rollup, reduced[0])), reduced[1])
+
+        keys, self.measures = _reduce([np.concatenate([self.keys[d], keys[d]]) for d in DIMENSIONS],
+                                      {m: np.concatenate([self.measures[m], measures[m]]) for m in MEASURES})
+        self.keys = dict(zip(DIMENSIONS, keys))
+        return self
+
+    def _source(self, dimensions):
+        """
+        Keys and measures of the smallest rollup holding dimensions, the cells if none does
+        """
+        keys, measures = self.keys, self.measures
+        for rollup, (rollup_keys, rollup_measures) in self.rollups.items():
+            if set(dimensions) <= set(rollup) and len(rollup_measures["count"]) < len(measures["count"]):
+                keys, measures = rollup_keys, rollup_measures
+        return keys, measures
+
+    @profiling.timed("RollupCube.add")
+    def add(self, df, error_values=[999]):
+        """
+        Add visits, without the error values in age as clean_column_pair
+        df: clean.PreparedFrame or dataframe with the entry date parsed and the weekday and hour columns
+        """
+        name = self.name
+        d = clean.clean_column_pair(df, name("age"), None, error_values, False)
+
+        dates = d[name("entry_date")].to_numpy(dtype="datetime64[ns]").view(np.int64)
+        keep = dates != NAT
+        days = dates[keep] // (86400 * 10**9)
+        keys = [days] + [np.asarray(d[name(c)], dtype=np.float64)[keep].astype(np.int64) for c in DIMENSIONS[1:]]
+        keys[-1] = keys[-1] // self.age_band * self.age_band
+
+        values = d[name("duration")].to_numpy(dtype=np.float64)[keep]
+        valid = ~np.isnan(values)
+        values = np.where(valid, values, 0)
+        measures = {"count": valid.astype(np.int64), "sum": values, "m2": np.zeros(len(values)),
+                    "min": np.where(valid, values, np.inf), "max": np.where(valid, values, -np.inf)}
+        return self._combine(keys, measures)
+
+    def merge(self, other):
+        """
+        Add the cells of another cube with the same age bands
+        """
+        if self.age_band != other.age_band:
+            raise ValueError("Rollup cubes with different age bands can't be merged")
+        return self._combine([other.keys[d] for d in DIMENSIONS], other.measures)
+
+    def query(self, by=[], **filters):
+        """
+        Measures of the cells matching filters, aggregated by the dimensions in by
+        by: list of dimensions, e.g. ["hour"]; filters: dimension=value or dimension=[values], e.g. department=53, weekday=1
+        returns a dataframe indexed by the translated names of by, with count, sum, m2, min and max
+        """
+        keys, measures = self._source(list(by) + list(filters))
+        mask = np.ones(len(measures["count"]), dtype=bool)
+        for dimension, values in filters.items():
+            if np.ndim(values) == 0:
+                mask &= keys[dimension] == values
+            else:
+                mask &= np.isin(keys[dimension], values)
+        keys, measures = _reduce([keys[d][mask] for d in by], {m: v[mask] for m, v in measures.items()})
+
+        if len(by) == 1:
+            index = pd.Index(keys[0], name=self.name(by[0]))
+        elif by:
+            index = pd.MultiIndex.from_arrays(keys, names=[self.name(d) for d in by])
+        else:
+            index = None
+        return pd.DataFrame(measures, index=index, columns=MEASURES)
+
+    def table(self, by=[], **filters):
+        """
+        Duration sum, min, mean, max, std (sample) and count like DataFrame.agg, see query
+        """
+        d_agg = self.query(by, **filters)
+        # Computed on the arrays, the tables are small enough for pandas overhead to dominate
+        count, total = d_agg['count'].to_numpy(), d_agg['sum'].to_numpy()
+        empty = count == 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(empty, np.nan, total / count)
+            std = np.where(count > 1, np.sqrt(d_agg['m2'].to_numpy() / (count - 1)), np.nan)
+        return pd.DataFrame({'sum': total, 'min': np.where(empty, np.nan, d_agg['min'].to_numpy()), 'mean': mean,
+                             'max': np.where(empty, np.nan, d_agg['max'].to_numpy()), 'std': std, 'count': count},
+                            index=d_agg.index)
+
+    def save(self, path):
+        """
+        Store the cells in a .npz file
+        """
+        arrays = {"key_" + d: v for d, v in self.keys.items()}
+        arrays.update(self.measures)
+        for i, rollup in enumerate(ROLLUPS):
+            keys, measures = self.rollups[rollup]
+            arrays.update({"rollup{0}_key_{1}".format(i, d): v for d, v in keys.items()})
+            arrays.update({"rollup{0}_{1}".format(i, m): v for m, v in measures.items()})
+        np.savez(path, age_band=self.age_band, **arrays)
+        return path
+
+    @classmethod
+    def load(cls, path, language="en", column_names=clean.COLUMN_NAMES):
+        """
+        Read the cells stored by save
+        """
+        with np.load(path) as arrays:
+            cube = cls(language, column_names, int(arrays["age_band"]))
+            cube.keys = {d: arrays["key_" + d] for d in DIMENSIONS}
+            cube.measures = {m: arrays[m] for m in MEASURES}
+            for i, rollup in enumerate(ROLLUPS):
+                if "rollup{0}_count".format(i) in arrays:
+                    cube.rollups[rollup] = ({d: arrays["rollup{0}_key_{1}".format(i, d)] for d in rollup},
+                                            {m: arrays["rollup{0}_{1}".format(i, m)] for m in MEASURES})
+                else:
+                    # Cubes saved without their rollups get them from the cells
+                    keys, measures = _reduce([cube.keys[d] for d in rollup], cube.measures)
+                    cube.rollups[rollup] = (dict(zip(rollup, keys)), measures)
+        return cube
+
+
+@profiling.timed()
+def load_cube(filename, delimiter=",", error_values=[999], language="en", column_names=clean.COLUMN_NAMES,
+              cache_dir=clean.CACHE_DIR, age_band=1, prepared=None, print_intermediate=True):
+    """
+    Rollup cube of the visits in filename, stored next to the prepared dataframes of clean.load_prepared
+    and rebuilt when the file or the settings change
+    prepared: clean.PreparedFrame of filename, read with clean.load_prepared if needed
+    """
+    path = None
+    if cache_dir is not None:
+        key = clean.cache_key(filename, error_values, language, column_names)
+        name = clean.cache_name(filename, language, age_band)
+        path = os.path.join(cache_dir, "{0}.{1}.cube.npz".format(name, key))
+        if os.path.exists(path):
+            if print_intermediate:
+                print("\nLoading rollup cube from", path)
+            return RollupCube.load(path, language, column_names)
+
+    if prepared is None:
+        prepared = clean.load_prepared(filename, delimiter, error_values, language, column_names, cache_dir, False, print_intermediate)
+    cube = RollupCube(language, column_names, age_band).add(prepared, error_values)
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Remove stale cubes of the same file, language and age bands, as clean.load_prepared does
+        for old in os.listdir(cache_dir):
+            if old.startswith(name + ".") and old.endswith(".cube.npz"):
+                os.remove(os.path.join(cache_dir, old))
+        cube.save(path)
+    return cube
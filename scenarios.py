@@ -0,0 +1,113 @@
+import os, glob
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import numpy as np
+
+import clean
+import profiling
+
+FORMAT = '%d/%m/%Y %H:%M:%S'
+
+COLUMN_NAMES = {
+                "scenario":
+                    {"en": "scenario", "es": "escenario"},
+                "Created":
+                    {"en": "Created", "es": "entrada"},
+                "Removed":
+                    {"en": "Removed", "es": "salida"},
+                "Duration":
+                    {"en": "Duration", "es": "duracion"},
+                "Hour":
+                    {"en": "Hour", "es": "hora"},
+                }
+
+
+def scenario_paths(paths):
+    """
+    Expand a glob pattern, or a list of patterns and paths, into a sorted list of files
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    output = []
+    for path in paths:
+        output.extend(sorted(glob.glob(path)) if glob.has_magic(path) else [path])
+    return output
+
+
+def load_scenario(filename, format=FORMAT, delimiter=",", scenario=None):
+    """
+    Read a FlexSim output (LastMilestoneAcheivedColumn,Created,Removed,PID) with vectorized date parsing
+    Adds the scenario name (file name without extension), the duration in minutes and the hour of arrival
+    """
+    df = pd.read_csv(filename, sep=delimiter, header=0)
+    # The trailing delimiter of every line adds an unnamed column
+    df = df.drop(columns=[c for c in df.columns if c.startswith("Unnamed")])
+
+    for column in ["Created", "Removed"]:
+        df[column] = pd.to_datetime(df[column], format=format)
+
+    df.insert(0, "scenario", scenario or os.path.splitext(os.path.basename(filename))[0])
+    df["Duration"] = (df["Removed"] - df["Created"]).to_numpy().view(np.int64) / 10**9 / 60
+    df["Hour"] = df["Created"].dt.hour.astype(np.int8)
+
+    return df
+
+
+@profiling.timed()
+def load_scenarios(paths, format=FORMAT, delimiter=",", workers=None, language="en", column_names=COLUMN_NAMES,
+                   print_intermediate=True):
+    """
+    Load many scenario files concurrently into a single long dataframe, in the order of the paths
+    paths: glob pattern (e.g. "Escenario*.csv") or list of patterns and paths
+    workers: number of threads, None for the default of ThreadPoolExecutor
+    """
+    paths = scenario_paths(paths)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = list(executor.map(lambda path: load_scenario(path, format, delimiter), paths))
+
+    df = pd.concat(frames, ignore_index=True, copy=False) if frames else pd.DataFrame()
+    df["scenario"] = pd.Categorical(df["scenario"], categories=list(dict.fromkeys(df["scenario"])))
+    df = clean.column_translator(df, language, column_names, False)
+
+    if print_intermediate:
+        print("\nLoaded {0} scenarios, {1} rows".format(len(frames), len(df)))
+
+    return df
+
+
+@profiling.timed()
+def compare_scenarios(df, language="en", column_names=COLUMN_NAMES, print_intermediate=True):
+    """
+    Table with a row per scenario: duration statistics, first entry, last exit and hourly throughput
+    (patients per hour between the first entry and the last exit), computed in a single groupby
+    df: dataframe returned by load_scenarios
+    """
+    scenario, created, removed, duration = [column_names[c][language] for c in ["scenario", "Created", "Removed", "Duration"]]
+
+    table = df.groupby(scenario, observed=True).agg(
+                count=(duration, 'count'),
+                mean=(duration, 'mean'),
+                std=(duration, 'std'),
+                min=(duration, 'min'),
+                median=(duration, 'median'),
+                max=(duration, 'max'),
+                first_entry=(created, 'min'),
+                last_exit=(removed, 'max'),
+                )
+    hours = (table['last_exit'] - table['first_entry']) / np.timedelta64(1, 'h')
+    table['throughput'] = table['count'] / hours
+
+    if print_intermediate:
+        print(table)
+
+    return table
+
+
+def hourly_arrivals(df, language="en", column_names=COLUMN_NAMES):
+    """
+    Arrivals by hour (rows) and scenario (columns)
+    """
+    scenario, hour = column_names["scenario"][language], column_names["Hour"][language]
+    return df.groupby([hour, scenario], observed=True).size().unstack(fill_value=0)
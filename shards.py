@@ -0,0 +1,226 @@
+import os, tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+
+import clean
+import profiling
+
+# Shared memory filesystem of Linux, the temporary directory is used elsewhere
+SHARED_DIR = "/dev/shm"
+
+
+def partition(df, column):
+    """
+    Sort the rows of df by column (stable, so every shard keeps the order of df) so that the rows of every
+    value are contiguous
+    returns (sorted dataframe, {value: (first row, last row + 1)}) with the values sorted and only those with rows
+    """
+    codes, values = pd.factorize(df[column], sort=True)
+    if isinstance(values, pd.CategoricalIndex):
+        values = values.categories[values.codes]
+    # NumPy sorts 16 bit integers with a radix sort, linear in the rows
+    order = np.argsort(codes.astype(np.int16) if len(values) < 2**15 else codes, kind="stable")
+    counts = np.bincount(codes[codes >= 0], minlength=len(values))
+    stops = np.cumsum(counts)
+    # Rows without a value (code -1) are sorted first and belong to no shard
+    skipped = int((codes < 0).sum())
+    bounds = {value: (skipped + stop - n, skipped + stop) for value, n, stop in zip(values, counts, stops) if n > 0}
+    return df.take(order), bounds
+
+
+def chunks(bounds, number):
+    """
+    Group the consecutive values of bounds (see partition) in about number chunks with similar numbers of rows
+    returns {tuple of values: (first row, last row + 1)}
+    """
+    output, values, first = {}, [], None
+    items = list(bounds.items())
+    total = sum(stop - start for value, (start, stop) in items)
+    size = total / max(number, 1)
+    for value, (start, stop) in items:
+        if first is None:
+            first = start
+        values.append(value)
+        if stop - items[0][1][0] >= size * (len(output) + 1) or value == items[-1][0]:
+            output[tuple(values)] = (first, stop)
+            values, first = [], None
+    return output
+
+
+class SharedFrame:
+    """
+    A dataframe written once as an Arrow IPC file in shared memory (/dev/shm where there is one), so that
+    worker processes memory map it and slice their rows without copying or pickling the dataframe
+    close() removes the file
+    """
+    def __init__(self, df):
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        handle, self.path = tempfile.mkstemp(suffix=".arrow", dir=SHARED_DIR if os.path.isdir(SHARED_DIR) else None)
+        os.close(handle)
+        with pa.OSFile(self.path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    @property
+    def source(self):
+        """
+        What the workers need to find the dataframe, see read_rows
+        """
+        return self.path
+
+    def close(self):
+        os.remove(self.path)
+
+
+def read_rows(source, first, stop):
+    """
+    Rows first to stop of a dataframe given as SharedFrame.source, or of the dataframe itself
+    """
+    if isinstance(source, pd.DataFrame):
+        return source.iloc[first:stop]
+
+    import pyarrow as pa
+
+    # Reading the memory mapped file and slicing it don't copy, only the rows of the shard are converted
+    with pa.memory_map(source, "r") as file:
+        return pa.ipc.open_file(file).read_all().slice(first, stop - first).to_pandas()
+
+
+def _run_shard(args):
+    """
+    Read a shard and run the function on it, used by the process pool
+    """
+    function, source, first, stop, key, extra = args
+    return function(read_rows(source, first, stop), key, *extra)
+
+
+def map_shards(df, column, function, args=(), workers=None, print_intermediate=True):
+    """
+    Run function(rows, value, *args) on the rows of every value of column (e.g. every department)
+    in a pool of workers processes, 1 to run in this process
+    function has to be defined at the top level of a module so that the workers can find it
+    returns {value: result} in the sorted order of the values
+    """
+    d, bounds = partition(df, column)
+    return run_shards(d, bounds, function, args, workers, print_intermediate)
+
+
+@profiling.timed()
+def run_shards(d, bounds, function, args=(), workers=None, print_intermediate=True):
+    """
+    map_shards on a dataframe already split by partition
+    The rows are shared with the workers through a SharedFrame when pyarrow is installed, pickled otherwise
+    """
+    if workers == 1 or len(bounds) < 2:
+        return {key: function(d.iloc[first:stop], key, *args) for key, (first, stop) in bounds.items()}
+
+    try:
+        shared = SharedFrame(d)
+    except ImportError:
+        print("pyarrow is not installed, the shards will be pickled")
+        shared = None
+
+    try:
+        # A pickled shard is sent alone, its rows are then 0 to stop - first
+        tasks = [(function, shared.source, first, stop, key, args) if shared is not None else
+                 (function, d.iloc[first:stop], 0, stop - first, key, args) for key, (first, stop) in bounds.items()]
+        # Largest shards first, so that a big department doesn't finish last alone
+        order = sorted(range(len(tasks)), key=lambda i: tasks[i][2] - tasks[i][3])
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = dict(zip(order, executor.map(_run_shard, [tasks[i] for i in order])))
+    finally:
+        if shared is not None:
+            shared.close()
+
+    if print_intermediate:
+        print("\nRan {0} shards in {1} processes".format(len(tasks), workers or os.cpu_count()))
+
+    return {key: results[i] for i, key in enumerate(bounds)}
+
+
+def criteria_tables(rows, keys, criteria_name, columns, weekday, duration, y_axisname):
+    """
+    Tables and chart counts of a chunk of rows holding whole criteria values (e.g. departments), run by the workers
+    The chunk is grouped once for the tables and counted with a single bincount per column
+    keys: criteria values in the chunk; columns: Categoricals, counted on the categories of the whole frame
+    returns {key: (duration table by weekday as main.timedeltas_bars_times_by_criteria,
+                   {column: counted categories as clean.count_categories returns})}
+    """
+    tables = rows.groupby([criteria_name, weekday], observed=True)[duration].agg(['sum', 'min', 'mean', 'max', 'std']).sort_index()
+    groups = pd.Categorical(rows[criteria_name], categories=list(keys)).codes.astype(np.int64)
+
+    categories = {column: rows[column].cat.categories for column in columns}
+    counts = {}
+    for column in columns:
+        codes = rows[column].cat.codes.to_numpy().astype(np.int64)
+        valid = (codes >= 0) & (groups >= 0)
+        k = len(categories[column])
+        counts[column] = np.bincount(groups[valid] * k + codes[valid], minlength=len(keys) * k).reshape(len(keys), k)
+
+    # Tables are sorted by key, every key is sliced by position instead of xs, and the small frames
+    # are built from single arrays: per key pandas overhead would otherwise exceed the grouping itself
+    positions = tables.index.levels[0].get_indexer(list(keys))
+    firsts = np.searchsorted(tables.index.codes[0], positions, side="left")
+    stops = np.searchsorted(tables.index.codes[0], positions, side="right")
+    weekdays = tables.index.levels[1].take(tables.index.codes[1])
+    values = tables.to_numpy()
+    labels = {column: np.asarray(categories[column]) for column in columns}
+    headers = {column: pd.Index([column, y_axisname]) for column in columns}
+
+    def counted(column, i):
+        if np.issubdtype(labels[column].dtype, np.integer):
+            return pd.DataFrame(np.column_stack([labels[column], counts[column][i]]), columns=headers[column])
+        return pd.DataFrame({column: categories[column], y_axisname: counts[column][i]})
+
+    output = {}
+    for i, key in enumerate(keys):
+        output[key] = (pd.DataFrame(values[firsts[i]:stops[i]], index=weekdays[firsts[i]:stops[i]], columns=tables.columns),
+                       {column: counted(column, i) for column in columns})
+    return output
+
+
+def interarrival_histogram(d_sub, key, entry_date, bins=20, max_minutes=60):
+    """
+    clean.StreamHistogram of the minutes between consecutive arrivals of a shard, as main.entry_diffs
+    """
+    return clean.InterArrivals(max_minutes).add(d_sub[entry_date]).histogram(bins)
+
+
+@profiling.timed()
+def by_criteria(df, columns, error_values=[999], criteria_name=None, criteria=None, language="en",
+                messages=None, column_names=clean.COLUMN_NAMES, workers=None, print_intermediate=True):
+    """
+    Output of main.timedeltas_bars_times_by_criteria without drawing the charts, with the visits split by
+    criteria_name (e.g. department) in chunks of whole departments, whose tables and chart counts are
+    computed by workers processes (1 for a single chunk in this process)
+    The counted categories are added to every chart payload, so render.render_charts doesn't count them again
+    df: dataframe or clean.PreparedFrame; messages: main.MESSAGES, None to label the counts with the key "patients"
+    """
+    prepared = clean.prepare(df, error_values, language, column_names, False)
+    df__ = clean.clean_column_pair(prepared, column_names['age'][language], column_names['entry_date'][language], error_values, False)
+    weekday, duration = column_names['weekday'][language], column_names['duration'][language]
+    y_axisname = clean.labels(language, messages or {}).get("patients", "patients")
+
+    # The Categoricals keep the categories of the whole frame in every shard
+    d, bounds = partition(clean.as_categoricals(df__, columns), criteria_name)
+    # Only the columns used by the workers are shared with them
+    needed = list(dict.fromkeys([criteria_name, weekday, duration] + list(columns)))
+    number = 1 if workers == 1 else 4 * (workers or os.cpu_count() or 1)
+    results = run_shards(d[needed], chunks(bounds, number), criteria_tables,
+                         (criteria_name, columns, weekday, duration, y_axisname), workers, print_intermediate)
+    tables = {key: result for chunk in results.values() for key, result in chunk.items()}
+
+    output = []
+    for column in columns:
+        categories = list(d[column].cat.categories)
+        for key, value in clean.criteria_items(criteria):
+            if key in bounds:
+                first, stop = bounds[key]
+                d_tab, counted = tables[key]
+                title = "{0} {1}: {2} by {3}".format(criteria_name.capitalize(), key, value, column)
+                histogram_info = [d.iloc[first:stop], title, column, y_axisname, categories, counted[column]]
+                output.append([criteria_name, {key: value}, d_tab, histogram_info])
+    return output
@@ -0,0 +1,167 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+
+import clean
+import profiling
+
+# Columns of the FlexSim exports read by scenarios.load_scenario
+SCENARIO_HEADER = "LastMilestoneAcheivedColumn,Created,Removed,PID,"
+LAST_MILESTONE = 3
+
+
+def fit_arrival_rates(df, language="en", column_names=clean.COLUMN_NAMES):
+    """
+    Mean arrivals in every hour of every weekday: number of visits divided by the number of
+    calendar days with that weekday between the first and the last visit
+    df: dataframe or clean.PreparedFrame
+    returns a dataframe with weekdays 1 to 7 as rows and hours 0 to 23 as columns
+    """
+    prepared = clean.prepare(df, [999], language, column_names, False)
+    d = prepared.df
+    weekday, hour = column_names['weekday'][language], column_names['hour'][language]
+
+    counts = d.groupby([weekday, hour], observed=True).size().unstack(fill_value=0).reindex(index=range(1, 8), columns=range(24), fill_value=0)
+    # Every calendar day of the observed span counts, with or without visits
+    dates = d[column_names['entry_date'][language]].dropna()
+    calendar = pd.date_range(dates.min().normalize(), dates.max().normalize(), freq="D") if len(dates) > 0 else pd.DatetimeIndex([])
+    days = pd.Series(calendar.dayofweek + 1)
+    days = days.value_counts().reindex(range(1, 8), fill_value=0)
+
+    return counts.div(days.where(days > 0), axis=0).fillna(0)
+
+
+def fit_service_times(df, error_values=[999], language="en", column_names=clean.COLUMN_NAMES):
+    """
+    Durations (minutes) of the visits, resampled by the simulation
+    df: dataframe or clean.PreparedFrame with the duration already in minutes
+    """
+    validity = clean.validity(df, error_values)
+    durations = validity.df[column_names['duration'][language]].to_numpy(dtype=np.float64)
+    durations = durations[validity.column(column_names['duration'][language])]
+    return durations[~np.isnan(durations)]
+
+
+def draw_arrivals(rates, replications, rng):
+    """
+    Arrival minutes (since midnight) of every replication from hourly Poisson counts and uniform times within the hour
+    rates: mean arrivals in each of the 24 hours
+    returns a (replications, most arrivals) array, padded with inf and sorted by row
+    """
+    rates = np.asarray(rates, dtype=np.float64)
+    counts = rng.poisson(rates, size=(replications, len(rates)))
+    totals = counts.sum(axis=1)
+    width = max(int(totals.max()), 1)
+
+    # Hour of every arrival, replication by replication, then a uniform minute within it
+    hours = np.repeat(np.tile(np.arange(len(rates)), replications), counts.ravel())
+    rows = np.repeat(np.arange(replications), totals)
+    columns = np.arange(len(rows)) - np.repeat(np.cumsum(totals) - totals, totals)
+
+    arrivals = np.full((replications, width), np.inf)
+    arrivals[rows, columns] = 60 * (hours + rng.random(len(rows)))
+    return np.sort(arrivals, axis=1)
+
+
+def queue(arrivals, services, servers=1):
+    """
+    First come first served queue with servers servers, for every replication at once
+    arrivals: (replications, n) sorted arrival minutes padded with inf, services: (replications, n) minutes
+    returns the exit minutes, inf where there was no arrival
+    """
+    replications, n = arrivals.shape
+    free = np.zeros((replications, servers))
+    exits = np.full(arrivals.shape, np.inf)
+    rows = np.arange(replications)
+
+    # Patients are taken in arrival order, the loop is over patients and vectorized over replications
+    for i in range(n):
+        server = free.argmin(axis=1)
+        start = np.maximum(arrivals[:, i], free[rows, server])
+        end = start + services[:, i]
+        arrived = np.isfinite(arrivals[:, i])
+        free[rows[arrived], server[arrived]] = end[arrived]
+        exits[arrived, i] = end[arrived]
+    return exits
+
+
+def _simulate_batch(args):
+    """
+    Simulate a batch of replications, used by the process pool
+    """
+    rates, service_times, servers, replications, first, seed = args
+    rng = np.random.default_rng(seed)
+    arrivals = draw_arrivals(rates, replications, rng)
+    services = rng.choice(service_times, size=arrivals.shape)
+    exits = queue(arrivals, services, servers)
+
+    rows, columns = np.nonzero(np.isfinite(arrivals))
+    return pd.DataFrame({"replication": first + rows, "PID": columns + 1,
+                         "created": arrivals[rows, columns], "removed": exits[rows, columns]})
+
+
+@profiling.timed()
+def simulate(rates, service_times, servers=1, date="2020-08-18", replications=1, opening=None,
+             workers=None, batch_size=1000, seed=0, print_intermediate=True):
+    """
+    Simulate the X-ray unit during date replications times
+    rates: dataframe from fit_arrival_rates (the weekday of date is used) or 24 hourly rates
+    service_times: durations in minutes to resample, see fit_service_times
+    opening: (first hour, last hour) when patients are admitted, e.g. (8, 17); None for the whole day
+    workers: processes for the batches of batch_size replications, 1 to run in this process
+    Returns a long dataframe with replication, PID, Created and Removed, deterministic for a given seed
+    """
+    date = pd.Timestamp(date).normalize()
+    if isinstance(rates, pd.DataFrame):
+        rates = rates.loc[date.dayofweek + 1]
+    rates = np.asarray(rates, dtype=np.float64).copy()
+    if opening is not None:
+        hours = np.arange(24)
+        rates[(hours < opening[0]) | (hours >= opening[1])] = 0
+
+    batches = [(first, min(batch_size, replications - first)) for first in range(0, replications, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    tasks = [(rates, service_times, servers, size, first, s) for (first, size), s in zip(batches, seeds)]
+
+    if workers == 1 or len(tasks) < 2:
+        frames = [_simulate_batch(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            frames = list(executor.map(_simulate_batch, tasks))
+
+    df = pd.concat(frames, ignore_index=True)
+    df["Created"] = date + pd.to_timedelta(df.pop("created") * 60, unit="s").dt.round("s")
+    df["Removed"] = date + pd.to_timedelta(df.pop("removed") * 60, unit="s").dt.round("s")
+
+    if print_intermediate:
+        print("\nSimulated {0} replications, {1} patients".format(replications, len(df)))
+
+    return df
+
+
+def _flexsim_dates(dates):
+    """
+    Dates as in the FlexSim exports, e.g. 18/08/2020 8:02:56 (hours without a leading zero)
+    """
+    return dates.dt.strftime("%d/%m/%Y ") + dates.dt.hour.astype(str) + dates.dt.strftime(":%M:%S")
+
+
+def write_scenarios(df, directory=".", prefix="Simulacion"):
+    """
+    Write every replication of simulate to its own csv with the format of EscenarioA.csv
+    returns the list of files
+    """
+    os.makedirs(directory, exist_ok=True)
+    lines = (str(LAST_MILESTONE) + "," + _flexsim_dates(df["Created"]) + "," + _flexsim_dates(df["Removed"])
+             + "," + df["PID"].astype(str) + ",0")
+
+    paths = []
+    for replication, rows in lines.groupby(df["replication"]):
+        path = os.path.join(directory, "{0}{1:05d}.csv".format(prefix, replication))
+        with open(path, "w") as file:
+            file.write(SCENARIO_HEADER + "\n")
+            file.write("\n".join(rows) + "\n")
+        paths.append(path)
+    return paths
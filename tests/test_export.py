@@ -0,0 +1,20 @@
+import os
+
+import pandas as pd
+
+import export
+
+
+def test_export_replaces_earlier_stages(tmp_path):
+    """
+    A second export into the same directory keeps only its own stages
+    """
+    table = pd.DataFrame({"sum": [1.0, 2.0], "mean": [0.5, 1.0]}, index=pd.Index([1, 2], name="weekday"))
+    occupancy = pd.DataFrame({"total": [1, 2]}, index=pd.to_datetime(["2007-09-02 08:00", "2007-09-02 08:01"]))
+    export.export({"durations": (table,), "occupancy": (occupancy, pd.DataFrame({"peak": [2]}))}, str(tmp_path),
+                  print_intermediate=False)
+    export.export({"totals": ([table], [])}, str(tmp_path), print_intermediate=False)
+
+    assert sorted(os.listdir(tmp_path / "tables")) == ["stage=totals"]
+    tables = pd.read_parquet(tmp_path / "tables")
+    assert list(tables["stage"].unique()) == ["totals"]
@@ -0,0 +1,39 @@
+import pandas as pd
+
+import clean
+import main
+import shards
+from benchmarks import comparisons
+
+
+def test_pickled_shards_match_serial(monkeypatch):
+    """
+    Without pyarrow the shards are pickled to the workers, every shard must still hold its own rows
+    """
+    df = comparisons.synthetic_frame(20000, departments=30)
+    criteria = [{key: "Department {0}".format(key)} for key in range(1, 31)]
+    args = (["weekday", "hour"], [999], "department", criteria, "en", main.MESSAGES, clean.COLUMN_NAMES)
+    expected = shards.by_criteria(df, *args, workers=1, print_intermediate=False)
+
+    def missing(df):
+        raise ImportError("pyarrow")
+
+    monkeypatch.setattr(shards, "SharedFrame", missing)
+    result = shards.by_criteria(df, *args, workers=2, print_intermediate=False)
+
+    assert len(result) == len(expected)
+    for a, b in zip(expected, result):
+        assert a[1] == b[1]
+        pd.testing.assert_frame_equal(a[2], b[2])
+        pd.testing.assert_frame_equal(a[3][5], b[3][5])
+
+
+def test_by_criteria_without_messages():
+    """
+    The counts are labelled with the key "patients" when no messages are given
+    """
+    df = comparisons.synthetic_frame(2000, departments=5)
+    result = shards.by_criteria(df, ["weekday"], [999], "department", {key: str(key) for key in range(1, 6)}, workers=1,
+                                print_intermediate=False)
+    assert len(result) == 5
+    assert list(result[0][3][5].columns) == ["weekday", "patients"]